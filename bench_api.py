@@ -0,0 +1,286 @@
+"""
+Offline benchmarks for test_api.py
+Micro: VWB primitives. Macro: T1–T4 scenarios replayed against a scripted local model.
+Results go to JSON with environment metadata; --compare flags regressions against a baseline.
+"""
+import argparse, contextlib, csv, io, json, os, platform, random, statistics, subprocess, sys, tempfile, time, zipfile
+from xml.sax.saxutils import escape
+
+import test_api
+from test_api import VWB
+from vwb_load import load
+from zai_cassette import StubServer, reply, scripted, tool_call, tool_calls
+from zai_runner import RateLimiter
+
+
+def env():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError: commit = ""
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "platform": platform.platform(), "machine": platform.machine(), "cpus": os.cpu_count(),
+            "commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def timeit(fn, setup=None, repeat=7, min_time=0.05):
+    """Median and min seconds per call of ``fn(state)``; ``setup()`` builds fresh state per run."""
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        n, t0 = 0, time.perf_counter()
+        while True:
+            fn(state); n += 1
+            el = time.perf_counter() - t0
+            if el >= min_time or setup: break
+        times.append(el / n)
+    return {"median_s": statistics.median(times), "min_s": min(times), "runs": repeat}
+
+
+def table(rows, cols=4, seed=1):
+    rnd = random.Random(seed)
+    hdr = ["Produkt", "Kategoria", "Ilość", "Cena", "Region", "Kod"][:cols]
+    return [hdr] + [[f"P{i}", f"K{rnd.randint(1, 20)}", rnd.randint(1, 100), round(rnd.random() * 100, 2),
+                     f"R{rnd.randint(1, 5)}", f"{i:06d}"][:cols] for i in range(rows)]
+
+
+def filled(rows, cols=4):
+    wb = VWB()
+    wb.exec("write_range", {"start_cell": "A1", "data": table(rows, cols)})
+    return wb
+
+
+def with_pivot():
+    wb = filled(5)
+    wb.exec("create_pivot_table", {"name": "PT1", "source_range": "A1:D6", "row_fields": ["Kategoria"],
+                                   "value_fields": ["Cena"], "dest_cell": "G1"})
+    return wb
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows(rows)
+
+
+def write_xlsx(path, rows):
+    # minimal package: one sheet, inline strings, no styles; cell references as Excel writes them
+    ns = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    cell = lambda r, c, v: (f'<c r="{c}{r}" t="inlineStr"><is><t>{escape(v)}</t></is></c>' if isinstance(v, str)
+                            else f'<c r="{c}{r}"><v>{v}</v></c>')
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("xl/workbook.xml", f'<workbook xmlns="{ns}" xmlns:r="http://schemas.openxmlformats.org/'
+                   'officeDocument/2006/relationships"><sheets><sheet name="Dane" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        z.writestr("xl/_rels/workbook.xml.rels", '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+                   'relationships"><Relationship Id="rId1" Target="worksheets/sheet1.xml"/></Relationships>')
+        z.writestr("xl/worksheets/sheet1.xml", f'<worksheet xmlns="{ns}"><sheetData>' + "".join(
+            f'<row r="{i}">{"".join(cell(i, "ABCDEF"[j], v) for j, v in enumerate(r))}</row>'
+            for i, r in enumerate(rows, 1)) + "</sheetData></worksheet>")
+
+
+# ── checks ──
+def _cell(wb, a, sheet=None):
+    r = wb.exec("read_cell", {"cell": a, "sheet": sheet} if sheet else {"cell": a})
+    return r["value"], r["formula"]
+
+
+def _run(wb, calls):
+    for name, args in calls:
+        res = wb.exec(name, args)
+        assert "error" not in res, (name, args, res)
+
+
+def checks():
+    """Correctness of the structural edits the benchmarks time: formulas follow rows."""
+    col = lambda n, v: [("write_cell", {"cell": f"A{i}", "value": v(i)}) for i in range(1, n + 1)]
+    # a moved formula keeps its formula; a range grows with rows inserted inside it
+    wb = VWB()
+    _run(wb, col(5, lambda i: i) + [("write_cell", {"cell": "A10", "value": "=SUM(A1:A5)"}),
+                                     ("write_cell", {"cell": "B1", "value": "=SUM(A2:A5)"}),
+                                     ("insert_rows", {"at_row": 2, "count": 2})])
+    assert _cell(wb, "A12") == (15, "=SUM(A1:A7)") and _cell(wb, "B1") == (14, "=SUM(A4:A7)"), _cell(wb, "A12")
+    # a fill moves as one block; references to deleted rows become #REF!
+    wb = VWB()
+    _run(wb, col(10, lambda i: i) + [("insert_formula", {"cell": "B1", "formula": "=A1*2", "fill_to": "B10"}),
+                                      ("write_cell", {"cell": "C1", "value": "=A5+$A$6"}),
+                                      ("delete_rows", {"start_row": 5})])
+    assert _cell(wb, "B5") == (12, "=A5*2") and _cell(wb, "B10") == ("", ""), _cell(wb, "B5")
+    assert _cell(wb, "C1") == ("#REF!", "=#REF!+$A$5"), _cell(wb, "C1")
+    _run(wb, [("delete_rows", {"start_row": 1, "count": 20}), ("write_cell", {"cell": "D1", "value": "=SUM(A1:A3)"}),
+              ("delete_rows", {"start_row": 1, "count": 3})])
+    assert _cell(wb, "D1") == ("", "")  # the formula's own row went with it
+    # other sheets follow a row shift, a rename and a delete
+    wb = VWB()
+    _run(wb, [("add_sheet", {"name": "Data"}), ("write_cell", {"cell": "A3", "value": 9, "sheet": "Data"}),
+              ("write_cell", {"cell": "B1", "value": "=Data!A3*2"}), ("insert_rows", {"at_row": 1, "sheet": "Data"}),
+              ("rename_sheet", {"sheet": "Data", "new_name": "My Data"})])
+    assert _cell(wb, "B1") == (18, "='My Data'!A4*2"), _cell(wb, "B1")
+    _run(wb, [("delete_sheet", {"sheet": "My Data"})])
+    assert _cell(wb, "B1") == ("#REF!", "=#REF!*2"), _cell(wb, "B1")
+    # sorting moves formulas with their rows; copies shift relative references
+    wb = VWB()
+    _run(wb, col(3, lambda i: 4 - i) + [("insert_formula", {"cell": "B1", "formula": "=A1*10", "fill_to": "B3"}),
+                                         ("sort_range", {"range": "A1:B3", "sort_column": "A", "has_headers": False}),
+                                         ("copy_range", {"source": "B1:B3", "destination": "B1", "dest_sheet": "S2"}),
+                                         ("write_cell", {"cell": "A1", "value": 7, "sheet": "S2"})])
+    assert [_cell(wb, f"B{i}") for i in (1, 3)] == [(10, "=A1*10"), (30, "=A3*10")], _cell(wb, "B1")
+    assert _cell(wb, "B1", "S2") == (70, "=A1*10"), _cell(wb, "B1", "S2")
+    # undo brings a moved formula back to its old row, redo moves it again
+    wb = VWB()
+    _run(wb, [("write_cell", {"cell": "A1", "value": 1}), ("write_cell", {"cell": "A5", "value": "=A1+1"})])
+    s0 = wb.snapshot()
+    _run(wb, [("insert_rows", {"at_row": 1, "count": 3})])
+    s1 = wb.snapshot()
+    wb.restore(s0)
+    assert _cell(wb, "A5") == (2, "=A1+1") and _cell(wb, "A8") == ("", ""), _cell(wb, "A5")
+    wb.restore(s1)
+    _run(wb, [("write_cell", {"cell": "A4", "value": 5})])
+    assert _cell(wb, "A8") == (6, "=A4+1") and _cell(wb, "A5") == ("", ""), _cell(wb, "A8")
+
+
+# ── micro ──
+def undo(wb):
+    snap = wb.snapshot()
+    wb.exec("write_cell", {"cell": "B2", "value": "x"})
+    wb.restore(snap)
+
+
+def redo(wb):
+    s0 = wb.snapshot()
+    wb.exec("write_cell", {"cell": "B2", "value": "x"})
+    wb.exec("insert_formula", {"cell": "E2", "formula": "=C2*D2", "fill_to": "E6"})
+    s1 = wb.snapshot()
+    wb.restore(s0)
+    wb.restore(s1)
+    wb.restore(s0)
+
+
+def micro(quick):
+    sizes = [100, 10_000] if quick else [100, 10_000, 100_000]
+    wb = VWB()
+    out = {
+        "parse/_pc": timeit(lambda _: wb._pc("$AB$1234")),
+        "parse/_pr": timeit(lambda _: wb._pr("A1:$XFD$1048576")),
+    }
+    for n in sizes:
+        data = table(n)
+        out[f"write_range/{n}x4"] = timeit(lambda w: w.exec("write_range", {"start_cell": "A1", "data": data}),
+                                           setup=VWB)
+        big = filled(n)
+        out[f"read_range/{n}x4"] = timeit(lambda _: big.exec("read_range", {"range": f"A1:D{n+1}"}))
+        out[f"get_sheet_info/{n}x4"] = timeit(lambda _: big.exec("get_sheet_info", {}))
+        out[f"fork/{n}x4"] = timeit(lambda _: big.fork())
+        out[f"snapshot_write_restore/{n}x4"] = timeit(lambda _: undo(big))
+        out[f"undo_redo/{n}x4"] = timeit(lambda _: redo(big))
+        out[f"create_pivot_table/{n}"] = timeit(
+            lambda w: w.exec("create_pivot_table", {"source_range": f"A1:D{n+1}", "row_fields": ["Kategoria"],
+                                                    "value_fields": ["Cena"], "dest_cell": "G1"}),
+            setup=lambda: filled(n))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            for ext, write in (("csv", write_csv), ("xlsx", write_xlsx)):
+                path = os.path.join(tmp, f"t{n}.{ext}")
+                write(path, table(n))
+                out[f"load_{ext}/{n}x4"] = timeit(lambda _: load(VWB(), path))
+    return out
+
+
+# ── macro ──
+SCRIPTS = {
+    "T1": ("Stwórz małą tabelę z kolumnami: Produkt, Kategoria, Ilość, Cena i tabelę przestawną", VWB, [
+        tool_call("get_sheet_info"),
+        tool_call("write_range", start_cell="A1", data=[[str(v) for v in r] for r in table(5)]),
+        tool_calls(*[("insert_formula", {"cell": f"E{r}", "formula": f"=C{r}*D{r}"}) for r in range(2, 7)]),
+        tool_call("create_pivot_table", source_range="A1:D6", row_fields=["Kategoria"], value_fields=["Cena"]),
+        tool_call("read_range", range="A1:E6"),
+        reply("Gotowe: tabela A1:E6 i tabela przestawna PT1.")]),
+    "T2": ("Sformatuj tabelę — pogrubiony nagłówek, obramowanie", lambda: filled(5), [
+        tool_call("get_sheet_info"),
+        tool_calls(("format_range", {"range": "A1:D1", "bold": True}),
+                   ("format_range", {"range": "A1:D6", "borders": True}),
+                   ("format_range", {"range": "D2:D6", "number_format": "0.00 zł"})),
+        reply("Sformatowano A1:D6.")]),
+    "T3": ("Przenieś tabelę przestawną na osobny arkusz i usuń puste wiersze 8-20", with_pivot, [
+        tool_calls(("get_sheet_info", {}), ("list_pivot_tables", {})),
+        tool_call("move_table", name="PT1", dest_sheet="Pivot"),
+        tool_call("delete_rows", start_row=8, count=13),
+        tool_call("read_range", range="A1:D20"),
+        reply("Przeniesiono PT1 i usunięto wiersze 8-20.")]),
+    "T4": ("Podsumuj dane w tym arkuszu", VWB, [
+        tool_call("get_sheet_info"),
+        reply("Arkusz jest pusty.")]),
+}
+
+
+def macro(quick):
+    test_api.LIMITER = RateLimiter(rate=1e6, burst=1e6, in_flight=64)
+    out = {}
+    with StubServer(responder=scripted({p: steps for p, _, steps in SCRIPTS.values()})) as srv:
+        test_api.API_BASE = srv.url
+        for name, (prompt, make, _) in SCRIPTS.items():
+            def go(wb, prompt=prompt, name=name):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    r = test_api.run(prompt, wb, name)
+                if r["stop"] != "ok": raise RuntimeError(f"{name}: stop={r['stop']}")
+            out[f"scenario/{name}"] = timeit(go, setup=make, repeat=5 if quick else 11)
+    return out
+
+
+# ── compare ──
+def compare(cur, base, threshold):
+    """Lines describing each benchmark; returns (lines, regressions).
+
+    Uses ``min_s``: the fastest run is the least disturbed by machine noise.
+    Baseline benchmarks missing from this run count as regressions, since
+    whatever they measured is no longer checked.
+    """
+    if cur.get("quick") != base.get("quick"):
+        raise ValueError(f"Cannot compare a {'quick' if cur.get('quick') else 'full'} run against a "
+                         f"{'quick' if base.get('quick') else 'full'} baseline")
+    lines, bad = [], []
+    for k, v in cur["results"].items():
+        b = base.get("results", {}).get(k)
+        if not b: lines.append(f"  ·  {k}: {v['min_s']*1e3:.3f} ms (new)"); continue
+        ratio = v["min_s"] / b["min_s"] if b["min_s"] else 1.0
+        flag = "❌" if ratio > 1 + threshold else ("✅" if ratio < 1 - threshold else "  ")
+        if ratio > 1 + threshold: bad.append(k)
+        lines.append(f"  {flag} {k}: {b['min_s']*1e3:.3f} → {v['min_s']*1e3:.3f} ms ({ratio:.2f}x)")
+    ran = {cur["only"]} if cur.get("only") else {"micro", "macro"}  # parts this run measured
+    for k in base.get("results", {}):
+        if k not in cur["results"] and ("macro" if k.startswith("scenario/") else "micro") in ran:
+            lines.append(f"  ❓ {k}: missing from this run"); bad.append(k)
+    return lines, bad
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Offline VWB / agent-loop benchmarks")
+    ap.add_argument("--out", default="bench_results.json", help="where to write the JSON results")
+    ap.add_argument("--compare", help="baseline JSON to compare against")
+    ap.add_argument("--threshold", type=float, default=0.15, help="relative slowdown counted as regression")
+    ap.add_argument("--quick", action="store_true", help="smaller sizes, fewer repeats")
+    ap.add_argument("--only", choices=["micro", "macro"], help="run one part only")
+    ap.add_argument("--check", action="store_true", help="run the correctness checks only")
+    opts = ap.parse_args()
+
+    checks()  # timings of wrong results are worthless
+    if opts.check: print("  ✅ checks passed"); sys.exit(0)
+    results = {}
+    if opts.only != "macro": results.update(micro(opts.quick))
+    if opts.only != "micro": results.update(macro(opts.quick))
+    doc = {"env": env(), "quick": opts.quick, "only": opts.only, "results": results}
+    with open(opts.out, "w", encoding="utf-8") as f:
+        json.dump(doc, f, indent=2, ensure_ascii=False)
+    for k, v in results.items():
+        print(f"  {k:32} {v['median_s']*1e3:10.3f} ms  (min {v['min_s']*1e3:.3f})")
+    print(f"\n  💾 {opts.out}")
+
+    if opts.compare:
+        with open(opts.compare, encoding="utf-8") as f:
+            base = json.load(f)
+        try: lines, bad = compare(doc, base, opts.threshold)
+        except ValueError as e: print(f"\n  ❌ {e}"); sys.exit(2)
+        print(f"\n  📊 vs {opts.compare} (commit {base.get('env', {}).get('commit', '?')})")
+        for l in lines: print(l)
+        if bad:
+            print(f"\n  ❌ {len(bad)} regression(s) over {opts.threshold:.0%} or missing benchmark(s)")
+            sys.exit(1)
+        print("\n  ✅ no regressions")
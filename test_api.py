@@ -2,23 +2,53 @@
 Z.AI API Communication Test (simplified)
 Tests: random table + pivot, prettify, move_table with pivot
 """
-import requests, json, sys, time
+import argparse, json, re, sys, threading, time
+from vwb_store import Sheet, shift_row, shift_span, sort_order, unique_rows
+from vwb_pivot import Pivot
+from vwb_formula import Engine
+from zai_runner import RateLimiter, is_rate_limited, make_session, run_many
+from zai_cassette import Cassette, StubServer
+from zai_stream import assemble
+from zai_history import History
+from zai_exec import footprint, run_calls
+from zai_trace import TRACER
+from zai_loop import LoopGuard
+from vwb_load import load as load_workbook
 
 API_BASE = "https://api.z.ai/api/paas/v4"
 API_KEY = "8cf9f0dda0b147f88eba639767510300.jZoc956GGNMKrdtO"
 MODEL = "glm-4.7-flash"
 MAX_ROUNDS = 30  # cap for test speed
-MAX_SAME_REPEATS = 2
+MAX_SAME_REPEATS = 2  # identical rounds (canonicalised calls) in a row before stopping
+MAX_RETRIES = 5  # attempts after HTTP 429 / z.ai 1302 before giving up
+TOOL_WORKERS = 4  # parallel tool calls per round when their footprints do not overlap
+HISTORY_BUDGET = 16000  # prompt tokens before stale tool results get compacted (0 = never)
 
 # ── Virtual Workbook (minimal) ─────────────────────────────────────
+def _cv(v):
+    # write_range coercion: numeric strings become numbers, whole floats become ints
+    t = type(v)
+    if t is int or v is None: return v
+    if t is float: return int(v) if v.is_integer() else v
+    try: f = float(v)
+    except: return v
+    try: return int(f) if f == int(f) else f
+    except: return f
+
 class VWB:
     def __init__(self):
-        self.sheets = {"Arkusz1": {}}
+        self.sheets = {"Arkusz1": Sheet()}
         self.active = "Arkusz1"
         self.pivots = {}
         self.charts = {}
+        self._pe = {}   # pivot name -> Pivot engine (pivots seeded as plain metadata have none)
+        self._out = {}  # pivot name -> (sheet, row, col, rows, cols) last written output
+        self._fx = Engine(self.sheets)  # formulas; results live in the sheets as plain values
+        self._calls = (None, None, 0)  # journal of exec()s: (previous, (name, args), depth), shared by snapshots
+        self._jlock = threading.Lock()  # exec() runs on the tool worker pool
 
     def _gs(self, s=None): return s or self.active
+    def _sh(self, sn): return self.sheets.setdefault(sn, Sheet())
     def _pc(self, a):
         col, row = "", ""
         for c in a.upper().replace("$",""):
@@ -28,6 +58,12 @@ class VWB:
         for c in col: ci = ci*26 + ord(c)-64
         return int(row), ci
 
+    def _ci(self, k, base=1):
+        # column given as a letter ("C") or a 1-based index relative to base
+        k = str(k).strip().replace("$","")
+        if k.isdigit(): return base + int(k) - 1
+        return self._pc(k + "1")[1]
+
     def _cl(self, i):
         r = ""
         while i > 0:
@@ -41,7 +77,111 @@ class VWB:
         r2,c2 = self._pc(p[1])
         return r1,c1,r2,c2
 
+    def _place(self, pn):
+        # (re)write a pivot's output at its destination, clearing what it no longer covers
+        meta, pe = self.pivots[pn], self._pe[pn]
+        tbl = pe.table()
+        ds = meta["dest_sheet"]
+        r, c = self._pc(meta["dest_cell"])
+        h, w = len(tbl), max(map(len, tbl))
+        old = self._out.get(pn)
+        if old and old[0] in self.sheets and old != (ds, r, c, h, w):
+            self.sheets[old[0]].clear(old[1], old[2], old[1]+old[3]-1, old[2]+old[4]-1)
+        self._sh(ds).write(r, c, tbl)
+        pe.refresh()  # output may overlap the source; settle before the next change
+        self._out[pn] = (ds, r, c, h, w)
+        return f"{self._cl(c)}{r}:{self._cl(c+w-1)}{r+h-1}"
+
+    def _shift_pivots(self, sn, at, n):
+        # sources and outputs on sheet sn follow rows inserted (n > 0) or deleted (n < 0) at row at
+        for pn, meta in self.pivots.items():
+            src, _, rng = meta["source"].rpartition("!")
+            if src.strip("'") == sn:
+                r1, c1, r2, c2 = self._pr(rng)
+                span = shift_span(r1, r2, at, n)
+                if span != (r1, r2):
+                    r1, r2 = span
+                    meta["source"] = f"{src}!{self._cl(c1)}{r1}:{self._cl(c2)}{r2}"
+                    if pn in self._pe:  # a new engine: snapshots may hold the old one
+                        pe = self._pe[pn]
+                        pe.close()
+                        self._pe[pn] = pe.clone(rng=(r1, c1, r2, c2))
+            if meta["dest_sheet"] == sn:
+                r, c = self._pc(meta["dest_cell"])
+                meta["dest_cell"] = f"{self._cl(c)}{shift_row(r, at, n)}"
+                o = self._out.get(pn)
+                if o and o[0] == sn: self._out[pn] = (sn, shift_row(o[1], at, n)) + o[2:]
+
+    def _sync_pivots(self):
+        for _ in range(len(self._pe)):
+            dirty = [pn for pn, pe in self._pe.items() if pe.stale or pe.dirty]
+            if not dirty: return
+            for pn in dirty:
+                try: self._place(pn)
+                except ValueError: pass  # source no longer has the fields; keep the last output
+
     def exec(self, name, args):
+        with self._jlock:
+            self._calls = (self._calls, (name, args), self._calls[2] + 1)
+        res = self._exec(name, args)
+        self._fx.flush()
+        if self._pe:
+            self._sync_pivots()
+            self._fx.flush()  # formulas reading pivot output
+        return res
+
+    # ── snapshots ──
+    def snapshot(self):
+        """Restore point. Sheets share their blocks with it copy-on-write, so
+        this costs O(sheets), not O(cells); call between exec()s."""
+        return {"sheets": [(n, sh, sh.snapshot()) for n, sh in self.sheets.items()],
+                "active": self.active, "pivots": {k: dict(v) for k, v in self.pivots.items()},
+                "charts": {k: dict(v) for k, v in self.charts.items()}, "out": dict(self._out),
+                "pe": dict(self._pe), "fx": self._fx.mark(), "calls": self._calls}
+
+    def restore(self, snap):
+        """Rewind to ``snapshot()``; returns the (name, args) calls undone.
+
+        Sheets get their old block maps back (watchers hear only about blocks
+        that differ) and the formula engine walks its journal to the snapshot,
+        back or forward (redo). Pivot engines are recreated and rebuild on the
+        next exec().
+        """
+        self._fx.rewind(snap["fx"])
+        for pe in self._pe.values(): pe.close()
+        self.sheets.clear()
+        for n, sh, st in snap["sheets"]:
+            sh.restore(st)
+            self.sheets[n] = sh
+        self._fx.pending = []  # restored values already match the restored formulas
+        self.active = snap["active"]
+        self.pivots = {k: dict(v) for k, v in snap["pivots"].items()}
+        self.charts = {k: dict(v) for k, v in snap["charts"].items()}
+        self._out = dict(snap["out"])
+        self._pe = {pn: pe.clone() for pn, pe in snap["pe"].items()}
+        a, b, undone = self._calls, snap["calls"], []
+        while a[2] > b[2]: undone.append(a[1]); a = a[0]
+        while b[2] > a[2]: b = b[0]  # snapshot ahead of us (redo) or on an undone branch
+        while a is not b:  # walk both back to the fork point
+            undone.append(a[1]); a, b = a[0], b[0]
+        with self._jlock: self._calls = snap["calls"]
+        return undone[::-1]
+
+    def fork(self):
+        """Independent workbook for another run, sharing all cell blocks copy-on-write."""
+        wb = VWB()
+        m = {sh: sh.fork() for sh in self.sheets.values()}
+        wb.sheets.clear()
+        wb.sheets.update((n, m[sh]) for n, sh in self.sheets.items())
+        wb.active = self.active
+        wb.pivots = {k: dict(v) for k, v in self.pivots.items()}
+        wb.charts = {k: dict(v) for k, v in self.charts.items()}
+        wb._out = dict(self._out)
+        wb._fx = self._fx.fork(wb.sheets, m)
+        wb._pe = {pn: pe.clone(m[pe.sheet]) for pn, pe in self._pe.items() if pe.sheet in m}
+        return wb
+
+    def _exec(self, name, args):
         s = args.get("sheet")
         sn = self._gs(s)
         try:
@@ -49,63 +189,70 @@ class VWB:
                 return {"file_name":"Test.xlsx","path":"C:\\Test.xlsx",
                         "sheets":list(self.sheets.keys()),"active_sheet":self.active}
             elif name == "get_sheet_info":
-                cells = self.sheets.get(sn, {})
-                if not cells:
+                cells = self.sheets.get(sn)
+                bx = cells.bbox() if cells is not None else None
+                if not bx:
                     return {"name":sn,"used_range":"","rows":0,"cols":0,"headers":[]}
-                mr = max(r for r,c in cells); mc = max(c for r,c in cells)
-                mnr = min(r for r,c in cells); mnc = min(c for r,c in cells)
-                hdrs = [str(cells.get((mnr,c),"")) for c in range(mnc, mc+1)]
+                mnr, mnc, mr, mc = bx
+                hdrs = ["" if v is None else str(v) for v in cells.read(mnr, mnc, mnr, mc)[0]]
                 return {"name":sn,"used_range":f"{self._cl(mnc)}{mnr}:{self._cl(mc)}{mr}",
                         "rows":mr-mnr+1,"cols":mc-mnc+1,"headers":hdrs}
             elif name == "read_cell":
                 r,c = self._pc(args["cell"])
                 v = self.sheets.get(sn,{}).get((r,c),"")
-                return {"cell":args["cell"],"value":v,"formula":"","type":"string" if v else "empty","sheet":sn}
+                f = self._fx.formula(self.sheets[sn], r, c) if sn in self.sheets else None
+                return {"cell":args["cell"],"value":v,"formula":f or "","type":"string" if v else "empty","sheet":sn}
             elif name == "write_cell":
                 r,c = self._pc(args["cell"])
                 v = args["value"]
+                if isinstance(v, str) and v.startswith("=") and len(v) > 1:
+                    v, _ = self._fx.set(self._sh(sn), r, c, v)
+                    return {"success":True,"cell":args["cell"],"value":v}
                 try: v = float(v);
                 except: pass
                 if v != args["value"] and v == int(v): v = int(v)
-                self.sheets.setdefault(sn,{})[(r,c)] = v
+                self._sh(sn).set(r, c, v)
                 return {"success":True,"cell":args["cell"],"value":v}
             elif name == "read_range":
                 r1,c1,r2,c2 = self._pr(args["range"])
-                data = []
-                for r in range(r1,r2+1):
-                    row = [self.sheets.get(sn,{}).get((r,c)) for c in range(c1,c2+1)]
-                    data.append(row)
+                cells = self.sheets.get(sn)
+                data = cells.read(r1,c1,r2,c2) if cells is not None else [[None]*(c2-c1+1) for _ in range(r1,r2+1)]
                 return {"range":args["range"],"sheet":sn,"rows":r2-r1+1,"cols":c2-c1+1,"data":data}
             elif name == "write_range":
                 r,c = self._pc(args["start_cell"])
-                w = 0
-                for ri, row in enumerate(args["data"]):
-                    for ci, val in enumerate(row):
-                        try:
-                            val = float(val)
-                            if val == int(val): val = int(val)
-                        except: pass
-                        self.sheets.setdefault(sn,{})[(r+ri, c+ci)] = val
-                        w += 1
-                return {"success":True,"start_cell":args["start_cell"],"rows_written":len(args["data"]),"cells_written":w}
+                rows = [[_cv(v) for v in row] for row in args["data"]]
+                sh = self._sh(sn)
+                w = sh.write(r, c, rows)
+                for ri, row in enumerate(rows):  # "=..." strings become formulas, as in Range.Value
+                    for ci, v in enumerate(row):
+                        if type(v) is str and v.startswith("=") and len(v) > 1: self._fx.set(sh, r+ri, c+ci, v)
+                return {"success":True,"start_cell":args["start_cell"],"rows_written":len(rows),"cells_written":w}
             elif name == "format_range":
                 return {"success":True,"range":args["range"],"sheet":sn}
             elif name == "insert_formula":
                 r,c = self._pc(args["cell"])
-                self.sheets.setdefault(sn,{})[(r,c)] = f"[F:{args['formula']}]"
-                return {"success":True,"cell":args["cell"],"formula":args["formula"]}
+                f = args["formula"] if args["formula"].startswith("=") else "=" + args["formula"]
+                r2,c2 = self._pc(args["fill_to"]) if args.get("fill_to") else (r,c)
+                v, n = self._fx.set(self._sh(sn), r, c, f, r2, c2)
+                return {"success":True,"cell":args["cell"],"formula":f,"result":v,"cells_filled":n}
             elif name == "add_sheet":
                 n = args.get("name") or f"Arkusz{len(self.sheets)+1}"
-                self.sheets[n] = {}
+                self.sheets[n] = Sheet()
                 return {"success":True,"name":n}
             elif name == "delete_rows":
                 sr = args["start_row"]
                 if sr < 1: return {"error":"start_row must be >= 1"}
-                return {"success":True,"deleted_from":sr,"count":args.get("count",1)}
+                n = max(int(args.get("count") or 1), 1)  # as the add-in: count < 1 means 1
+                self._fx.shift_rows(self._sh(sn), int(sr), -n)
+                self._shift_pivots(sn, int(sr), -n)
+                return {"success":True,"deleted_from":sr,"count":n}
             elif name == "insert_rows":
                 ar = args["at_row"]
                 if ar < 1: return {"error":"at_row must be >= 1"}
-                return {"success":True,"at_row":ar,"count":args.get("count",1)}
+                n = max(int(args.get("count") or 1), 1)  # as the add-in: count < 1 means 1
+                self._fx.shift_rows(self._sh(sn), int(ar), n)
+                self._shift_pivots(sn, int(ar), n)
+                return {"success":True,"at_row":ar,"count":n}
             elif name == "create_chart":
                 n = f"Chart {len(self.charts)+1}"
                 self.charts[n] = {"type":args.get("chart_type","column"),"data":args["data_range"]}
@@ -118,13 +265,25 @@ class VWB:
                 return {"charts":[{"name":k,"type":v["type"],"data_range":v["data"]} for k,v in self.charts.items()],"count":len(self.charts)}
             elif name == "create_pivot_table":
                 pn = args.get("name") or f"PT{len(self.pivots)+1}"
+                src = args["source_range"]
+                if "!" in src:
+                    sn, src = src.rsplit("!", 1); sn = sn.strip("'")
+                if sn not in self.sheets: return {"error":f"Sheet '{sn}' not found"}
+                pe = Pivot(self.sheets[sn], self._pr(src), args.get("row_fields") or [], args.get("value_fields") or [],
+                           args.get("column_fields") or [], args.get("value_function"))
+                try: pe.refresh()
+                except ValueError: pe.close(); raise
                 ds = sn
                 dc = args.get("dest_cell")
                 if not dc:
-                    ds = f"Pivot_{pn}"; self.sheets[ds] = {}; dc = "A1"
-                self.pivots[pn] = {"source":f"'{sn}'!{args['source_range']}","dest_sheet":ds,"dest_cell":dc,
-                                   "row_fields":args.get("row_fields",[]),"value_fields":args.get("value_fields",[])}
-                return {"success":True,"name":pn,"dest_sheet":ds,"dest_cell":dc}
+                    ds = f"Pivot_{pn}"; self.sheets[ds] = Sheet(); dc = "A1"
+                if pn in self._pe: self._pe.pop(pn).close()
+                self.pivots[pn] = {"source":f"'{sn}'!{src}","dest_sheet":ds,"dest_cell":dc,
+                                   "row_fields":args.get("row_fields",[]),"value_fields":args.get("value_fields",[]),
+                                   "column_fields":args.get("column_fields") or [],"value_function":pe.func}
+                self._pe[pn] = pe
+                out = self._place(pn)
+                return {"success":True,"name":pn,"dest_sheet":ds,"dest_cell":dc,"output_range":out}
             elif name == "list_pivot_tables":
                 pts = [{"name":k,"sheet":v["dest_sheet"],"location":v["dest_cell"],"source":v["source"]}
                        for k,v in self.pivots.items()
@@ -135,40 +294,96 @@ class VWB:
                 if not ds:
                     ds = f"Moved_{len(self.sheets)+1}"
                 if ds not in self.sheets:
-                    self.sheets[ds] = {}
+                    self.sheets[ds] = Sheet()
                 pn = args.get("name")
                 if pn and pn in self.pivots:
                     self.pivots[pn]["dest_sheet"] = ds
                     self.pivots[pn]["dest_cell"] = args.get("dest_cell","A1")
+                    if pn in self._pe: self._place(pn)
                     return {"success":True,"moved":"pivot_table","name":pn,"to_sheet":ds,"dest_cell":args.get("dest_cell","A1")}
                 return {"success":True,"moved":"data","to_sheet":ds,"dest_cell":args.get("dest_cell","A1")}
             elif name == "clear_range":
-                return {"success":True,"range":args["range"],"cleared":args.get("what","contents")}
+                what = (args.get("what") or "contents").lower()
+                if what != "formats": self._sh(sn).clear(*self._pr(args["range"]))
+                return {"success":True,"range":args["range"],"cleared":what}
             elif name == "sort_range":
-                return {"success":True,"range":args["range"],"sorted_by":args.get("sort_column","A")}
+                r1,c1,r2,c2 = self._pr(args["range"])
+                if args.get("has_headers", True): r1 += 1
+                sc = args.get("sort_column") or self._cl(c1)
+                cols = sc if isinstance(sc, list) else str(sc).split(",")
+                ords = str(args.get("order") or "asc").lower().split(",")
+                sh = self._sh(sn)
+                keys = []
+                for i, k in enumerate(cols):
+                    ci = self._ci(k, c1)
+                    if not c1 <= ci <= c2: return {"error":f"Sort column {k} is outside {args['range']}"}
+                    o = ords[min(i, len(ords)-1)].strip()
+                    keys.append((sh.read_col(ci, r1, r2), o in ("desc","descending")))
+                if r2 > r1: self._fx.take_rows(sh, r1, c1, r2, c2, sort_order(keys, r2-r1+1))
+                return {"success":True,"range":args["range"],"sort_column":sc}
             elif name == "auto_filter":
                 return {"success":True,"range":args["range"]}
             elif name == "find_replace":
-                return {"success":True,"find":args["find"],"replace":args["replace"],"replacements_made":0}
+                fs, rs = str(args["find"]), str(args["replace"])
+                sh = self._sh(sn)
+                box = self._pr(args["range"]) if args.get("range") else sh.bbox()
+                made = 0
+                if box and fs:
+                    r1,c1,r2,c2 = box
+                    fl = 0 if args.get("match_case") else re.IGNORECASE
+                    pat = re.compile(("^%s$" if args.get("match_entire") else "%s") % re.escape(fs), fl)
+                    for c in [c for c in sh.cols if c1 <= c <= c2]:
+                        col = sh.read_col(c, r1, r2)
+                        hits = [i for i, v in enumerate(col) if v is not None and pat.search(str(v))]
+                        if not hits: continue
+                        for i in hits: col[i] = _cv(pat.sub(lambda m: rs, str(col[i])))
+                        sh.write_col(c, r1, col)
+                        made += len(hits)
+                return {"success":made > 0,"find":fs,"replace":rs,"replacements_made":made}
             elif name == "conditional_format":
                 return {"success":True,"range":args["range"],"rule_type":args.get("rule_type","")}
             elif name == "copy_range":
+                r1,c1,r2,c2 = self._pr(args["source"])
+                dr,dc = self._pc(args["destination"].split(":")[0])
+                self._fx.copy(self._sh(sn), r1, c1, r2, c2, self._sh(args.get("dest_sheet") or sn), dr, dc)
                 return {"success":True,"source":args["source"],"destination":args["destination"]}
             elif name == "rename_sheet":
                 old = self._gs(s)
                 nn = args["new_name"]
                 self.sheets[nn] = self.sheets.pop(old)
+                self._fx.rename(old, nn)
                 if self.active == old: self.active = nn
+                for pn, v in self.pivots.items():
+                    if v["dest_sheet"] == old: v["dest_sheet"] = nn
+                    src, _, rng = v["source"].rpartition("!")
+                    if src.strip("'") == old: v["source"] = f"'{nn}'!{rng}"
+                    if pn in self._out and self._out[pn][0] == old: self._out[pn] = (nn,) + self._out[pn][1:]
                 return {"success":True,"old_name":old,"new_name":nn}
             elif name == "delete_sheet":
                 dn = args["sheet"]
                 if len(self.sheets) <= 1: return {"error":"Cannot delete the last sheet"}
-                if dn in self.sheets: del self.sheets[dn]; return {"success":True,"deleted":dn}
+                if dn in self.sheets:
+                    self._fx.forget(self.sheets.pop(dn), dn)
+                    for pn in [k for k, v in self.pivots.items() if v["dest_sheet"] == dn]:
+                        del self.pivots[pn]
+                        if pn in self._pe: self._pe.pop(pn).close()
+                    return {"success":True,"deleted":dn}
                 return {"error":f"Sheet '{dn}' not found"}
             elif name == "freeze_panes":
                 return {"success":True}
             elif name == "remove_duplicates":
-                return {"success":True,"range":args["range"],"rows_removed":0}
+                r1,c1,r2,c2 = self._pr(args["range"])
+                sh = self._sh(sn)
+                col = sh.read_col(c1, r1, r2); before = len(col) - col.count(None)
+                d1 = r1 + 1 if args.get("has_headers", True) else r1
+                sel = [int(x) for x in args.get("columns") or range(1, c2-c1+2)]
+                if any(not 1 <= x <= c2-c1+1 for x in sel): return {"error":f"columns must be within 1..{c2-c1+1}"}
+                if r2 >= d1:
+                    keep = unique_rows([sh.read_col(c1+x-1, d1, r2) for x in sel], r2-d1+1)
+                    if len(keep) < r2-d1+1: sh.take_rows(d1, c1, r2, c2, keep)
+                col = sh.read_col(c1, r1, r2); after = len(col) - col.count(None)
+                return {"success":True,"range":args["range"],"rows_before":before,"rows_after":after,
+                        "rows_removed":before-after}
             elif name == "set_validation":
                 return {"success":True,"range":args["range"]}
             else:
@@ -178,7 +393,24 @@ class VWB:
 
 
 # ── Tool definitions (compact) ──────────────────────────────────────
+_TOOLS = None       # schema list, built once
+_TOOLS_JSON = {}    # tuple of tool names -> pre-encoded JSON of that subset
+
 def tools():
+    """All tool schemas. Built once and shared, so callers must not mutate them."""
+    global _TOOLS
+    if _TOOLS is None: _TOOLS = _build_tools()
+    return _TOOLS
+
+def tools_json(tls):
+    """Compact UTF-8 JSON of a tool list, encoded once per distinct subset."""
+    key = tuple(t["function"]["name"] for t in tls)
+    b = _TOOLS_JSON.get(key)
+    if b is None:
+        b = _TOOLS_JSON[key] = json.dumps(tls, ensure_ascii=False, separators=(",",":")).encode("utf-8")
+    return b
+
+def _build_tools():
     def mt(n,d,p,r):
         return {"type":"function","function":{"name":n,"description":d,"parameters":{"type":"object","properties":p,"required":r}}}
     def ps(d): return {"type":"string","description":d}
@@ -198,8 +430,8 @@ def tools():
             "number_format":ps("Num fmt"),"h_align":ps("Align"),"wrap_text":pb("Wrap"),
             "borders":pb("Borders"),"column_width":pn("Col width"),"row_height":pn("Row height"),
             "autofit":pb("Autofit"),"merge":pb("Merge"),"sheet":ps("Sheet")},["range"]),
-        mt("insert_formula","Insert formula",{"cell":ps("Cell"),"formula":ps("Formula"),"sheet":ps("Sheet")},["cell","formula"]),
-        mt("sort_range","Sort range",{"range":ps("Range"),"sort_column":ps("Col"),"order":ps("asc/desc"),"has_headers":pb("Headers"),"sheet":ps("Sheet")},["range","sort_column"]),
+        mt("insert_formula","Insert formula",{"cell":ps("Cell"),"formula":ps("Formula"),"fill_to":ps("Fill to cell"),"sheet":ps("Sheet")},["cell","formula"]),
+        mt("sort_range","Sort range",{"range":ps("Range"),"sort_column":ps("Col or cols, e.g. A,C"),"order":ps("asc/desc, per col"),"has_headers":pb("Headers"),"sheet":ps("Sheet")},["range","sort_column"]),
         mt("add_sheet","Add sheet",{"name":ps("Name")},[]),
         mt("delete_rows","Delete rows",{"start_row":pn("Start row"),"count":pn("Count"),"sheet":ps("Sheet")},["start_row"]),
         mt("insert_rows","Insert rows",{"at_row":pn("At row"),"count":pn("Count"),"sheet":ps("Sheet")},["at_row"]),
@@ -210,7 +442,7 @@ def tools():
             "name":ps("Name"),"row_fields":{"type":"array","items":{"type":"string"},"description":"Row fields"},
             "column_fields":{"type":"array","items":{"type":"string"},"description":"Col fields"},
             "value_fields":{"type":"array","items":{"type":"string"},"description":"Value fields"},
-            "value_function":ps("Function"),"sheet":ps("Sheet")},["source_range","row_fields","value_fields"]),
+            "value_function":ps("sum/count/average/min/max"),"sheet":ps("Sheet")},["source_range","row_fields","value_fields"]),
         mt("move_table","Move data/PivotTable to another sheet. Use when pivot blocks delete_rows/insert_rows.",
             {"name":ps("PivotTable name"),"source_range":ps("Source range"),
              "dest_sheet":ps("Dest sheet"),"dest_cell":ps("Dest cell"),"sheet":ps("Source sheet")},[]),
@@ -234,6 +466,44 @@ def tools():
     ]
 
 
+# Tool subsetting: only send what the prompt / workbook state can use
+READ_ONLY = {"read_cell","read_range","get_sheet_info","get_workbook_info","list_charts","list_pivot_tables"}
+TOOL_GROUPS = {  # tools offered only when the workbook has such objects or the prompt asks for them
+    "pivot": ({"create_pivot_table","list_pivot_tables","move_table"}, ("pivot","przestawn")),
+    "chart": ({"create_chart","delete_chart","list_charts"}, ("chart","wykres")),
+}
+ANALYSIS_WORDS = ("podsumuj","summar","analiz","analy","ile ","how many","średni","average","pokaż","show",
+                  "opisz","describe","sprawdź","check","jakie","what")
+WRITE_WORDS = ("stwórz","utwórz","create","dodaj","add","zmień","change","usuń","delete","remove","przenieś",
+               "move","sformatuj","format","wpisz","write","oblicz","calculat","sortuj","sort","wstaw","insert",
+               "popraw","fix","wypełnij","fill","zamień","replace","kopiuj","copy","wyczyść","clear",
+               "make","build","zrób","przygotuj","put","umieść","generate","wygeneruj")
+TOOL_SUBSET = True
+
+def select_tools(prompt, wb, prev=None):
+    """Tool schemas relevant to ``prompt`` and ``wb``, in tools() order.
+
+    Pivot and chart tools are offered when the workbook already has those
+    objects or the prompt names them; naming one counts as asking to create
+    it. Only prompts with analysis words and neither a write verb nor a
+    pivot/chart word get the read-only tools. ``prev`` (the previous round's
+    selection) is always kept, so the set only grows within a run and the
+    encoded subset is reused.
+    """
+    all_t = tools()
+    if not TOOL_SUBSET: return all_t
+    p = prompt.lower()
+    names = {t["function"]["name"] for t in all_t}
+    named = {g for g, (grp, words) in TOOL_GROUPS.items() if any(w in p for w in words)}
+    if any(w in p for w in ANALYSIS_WORDS) and not named and not any(w in p for w in WRITE_WORDS):
+        names &= READ_ONLY
+    present = {"pivot": bool(wb.pivots), "chart": bool(wb.charts)}
+    for g, (grp, words) in TOOL_GROUPS.items():
+        if not present[g] and g not in named: names -= grp
+    if prev: names |= {t["function"]["name"] for t in prev}
+    return [t for t in all_t if t["function"]["name"] in names]
+
+
 SYSTEM_PROMPT = """You are an AI assistant integrated into Microsoft Excel through the Z.AI add-in. You have access to tools that can read and modify Excel workbooks.
 
 Rules you must follow:
@@ -253,22 +523,94 @@ Rules you must follow:
 
 
 # ── API + loop ──────────────────────────────────────────────────────
-def call_api(msgs, tls):
-    r = requests.post(f"{API_BASE}/chat/completions",
-        json={"model":MODEL,"messages":msgs,"max_tokens":4096,"temperature":0.7,"tools":tls,"tool_choice":"auto"},
-        headers={"Authorization":f"Bearer {API_KEY}","Content-Type":"application/json"},
-        timeout=120)
+SESSION = make_session()  # shared keep-alive pool for all scenarios
+LIMITER = RateLimiter()
+CASSETTE = None  # Cassette: replay recorded responses, record new ones
+STREAM = False   # request SSE chunks and assemble them as they arrive
+
+def call_api(msgs, tls, on_tool=None):
+    """POST one completion round. With STREAM, ``on_tool(index, tool_call)``
+    fires as soon as each tool call's arguments are complete."""
+    body = {"model":MODEL,"messages":msgs,"max_tokens":4096,"temperature":0.7,"tools":tls,"tool_choice":"auto"}
+    if STREAM: body["stream"] = True
+    with TRACER.span("call_api", "api", messages=len(msgs), tools=len(tls)) as sp:
+        data = _call_api(body, tls, on_tool, sp)
+        if data: sp.set(**{k: v for k, v in (data.get("usage") or {}).items() if isinstance(v, int)})
+    return data
+
+
+def _call_api(body, tls, on_tool, sp):
+    if CASSETTE is not None:
+        hit = CASSETTE.get(body)
+        if hit is not None:
+            sp.set(cassette="hit")
+            return hit
+    # tool schemas are spliced in pre-encoded; only the messages are serialised per round
+    with TRACER.span("encode", "serialize"):
+        raw = json.dumps({k:v for k,v in body.items() if k != "tools"}, ensure_ascii=False,
+                         separators=(",",":")).encode("utf-8")[:-1] + b',"tools":' + tools_json(tls) + b"}"
+    sp.set(request_bytes=len(raw))
+    data = None
+    for attempt in range(MAX_RETRIES+1):
+        with LIMITER, TRACER.span("http", "api", attempt=attempt) as hs:
+            t0 = time.perf_counter()
+            r = SESSION.post(f"{API_BASE}/chat/completions", data=raw,
+                headers={"Authorization":f"Bearer {API_KEY}","Content-Type":"application/json"},
+                timeout=120, stream=STREAM)
+            hs.set(status=r.status_code)
+            if r.status_code == 200:
+                if STREAM:
+                    lines = r.iter_lines(chunk_size=None)
+                    if TRACER.enabled: lines = _counted(lines, sp)
+                    data = assemble(lines, t0, on_tool)
+                else:
+                    with TRACER.span("decode", "serialize"):
+                        data = r.json()
+                    sp.set(response_bytes=len(r.content))
+                    data["_timing"] = {"ttft":None,"ttfc":None,"total":time.perf_counter()-t0}
+        if attempt == MAX_RETRIES or not is_rate_limited(r): break
+        try: ra = float(r.headers.get("Retry-After") or 0)
+        except ValueError: ra = 0
+        print(f" ⏳ rate limit, retry in {LIMITER.backoff(ra):.1f}s", end="", flush=True)
+    sp.set(status=r.status_code, retries=attempt)
     if r.status_code != 200:
         print(f"  ❌ HTTP {r.status_code}: {r.text[:300]}")
         return None
-    return r.json()
+    LIMITER.ok()
+    if data["_timing"]["ttft"] is not None: sp.set(ttft_ms=data["_timing"]["ttft"]*1e3)
+    if CASSETTE is not None: CASSETTE.put(body, {k:v for k,v in data.items() if k != "_timing"})
+    return data
+
+
+def _counted(lines, sp):
+    # response size of a streamed answer, for the trace
+    n = 0
+    try:
+        for l in lines:
+            n += len(l) + 1
+            yield l
+    finally:  # assemble() stops reading at [DONE]
+        sp.set(response_bytes=n)
+
+
+def traced_exec(wb, name, args, rnd=None):
+    if not TRACER.enabled: return wb.exec(name, args)
+    with TRACER.span(name, "tool", round=rnd) as sp:
+        r = wb.exec(name, args)
+        if isinstance(r, dict) and "error" in r: sp.set(error=r["error"])
+    return r
 
 
 def run(prompt, wb, label, max_rounds=MAX_ROUNDS):
     print(f"\n{'='*60}\n  TEST: {label}\n  User: {prompt}\n{'='*60}")
     msgs = [{"role":"system","content":SYSTEM_PROMPT.format(max_rounds=max_rounds)},
             {"role":"user","content":prompt}]
-    prev_sig, reps, total_tc = None, 0, 0
+    total_tc, timings = 0, []
+    guard = LoopGuard(wb, max_repeats=MAX_SAME_REPEATS)
+    hist = History(HISTORY_BUDGET) if HISTORY_BUDGET else None
+    def res(stop, rounds, **kw):
+        return dict(stop=stop, rounds=rounds, tools=total_tc, timings=timings,
+                    tokens_saved=sum(hist.saved) if hist else 0, **kw)
     # Track round_info index for replacement (like the fixed C# code)
     ri_idx = None
 
@@ -285,87 +627,157 @@ def run(prompt, wb, label, max_rounds=MAX_ROUNDS):
             msgs.append({"role":"user","content":f"This is your final response before reaching the {max_rounds} tool-round limit. Write yourself a summary of what you did and what's left."})
 
         print(f"  📡 R{rnd}/{max_rounds}...", end="", flush=True)
-        data = call_api(msgs, tools())
-        if not data:
-            return {"stop":"api_error","rounds":rnd,"tools":total_tc}
-
-        ch = data["choices"][0]
-        msg = ch["message"]
-
-        if msg.get("tool_calls"):
-            tcl = msg["tool_calls"]
-            print(f" {len(tcl)} tool(s)")
-            msgs.append(msg)
-            # shift ri_idx since we inserted assistant msg after it
-            # actually ri_idx was before this append, but since we replaced at ri_idx,
-            # the round info stays at same position. New messages go after.
-
-            sig = "|".join(f"{t['function']['name']}:{t['function']['arguments']}" for t in tcl)
-            if sig == prev_sig:
-                reps += 1
-                if reps >= MAX_SAME_REPEATS:
-                    print(f"  🔄 LOOP DETECTED"); return {"stop":"loop","rounds":rnd,"tools":total_tc}
-            else: reps = 0
-            prev_sig = sig
-
-            for tc in tcl:
-                fn = tc["function"]["name"]
-                fa = tc["function"]["arguments"]
-                tid = tc["id"]
-                total_tc += 1
-                try: args = json.loads(fa)
+        with TRACER.span("round", "round", label=label, round=rnd) as rs:
+            early = {}  # tool_call_id -> result of calls already run while streaming
+            held = []   # set once a call is held back; the rest of the message then waits for run_calls
+            def on_tool(i, tc):
+                if held: return  # running later calls now would overtake the held one
+                try: args = json.loads(tc["function"]["arguments"])
                 except: args = {}
-                result = wb.exec(fn, args)
-                rstr = json.dumps(result, ensure_ascii=False)
-                short_a = fa if len(fa)<70 else fa[:67]+"..."
-                short_r = rstr if len(rstr)<90 else rstr[:87]+"..."
-                print(f"    🔧 {fn}({short_a}) → {short_r}")
-                msgs.append({"role":"tool","content":rstr,"tool_call_id":tid})
-            continue
-
-        content = msg.get("content","")
-        if not content:
-            print(" ⚠️ EMPTY")
-            return {"stop":"empty","rounds":rnd,"tools":total_tc}
-        print(f" 💬 done")
-        print(f"  {'─'*50}")
-        for l in content.split("\n"): print(f"    {l}")
-        print(f"  {'─'*50}")
-        print(f"  ✅ {rnd} rounds, {total_tc} tool calls")
-        return {"stop":"ok","rounds":rnd,"tools":total_tc,"response":content}
+                # a call made in a recent round could be a loop or a re-read; leave it to the checks below
+                if guard.seen(guard.key(tc["function"]["name"], args)):
+                    held.append(i)
+                    return
+                early[tc["id"]] = traced_exec(wb, tc["function"]["name"], args, rnd)
+            tls = select_tools(prompt, wb, tls if rnd > 1 else None)
+            if hist:
+                sv = hist.compact(msgs, tools_json(tls))
+                if sv: print(f" 🗜️-{sv}tok", end="")
+            data = call_api(msgs, tls, on_tool)
+            if not data:
+                return res("api_error", rnd)
+            if hist: hist.observe(msgs, tools_json(tls), data.get("usage"))
+            rs.set(messages=len(msgs), **{k: v for k, v in (data.get("usage") or {}).items() if isinstance(v, int)})
+            tm = data.get("_timing")
+            if tm:
+                timings.append(tm)
+                if tm["ttft"] is not None:
+                    print(f" ⚡{tm['ttft']:.2f}s" + (f"/🔧{tm['ttfc']:.2f}s" if tm["ttfc"] is not None else ""), end="")
+
+            ch = data["choices"][0]
+            msg = ch["message"]
+
+            if msg.get("tool_calls"):
+                tcl = msg["tool_calls"]
+                print(f" {len(tcl)} tool(s)")
+                rs.set(tool_calls=len(tcl))
+                msgs.append(msg)
+                # shift ri_idx since we inserted assistant msg after it
+                # actually ri_idx was before this append, but since we replaced at ri_idx,
+                # the round info stays at same position. New messages go after.
+
+                parsed = []
+                for tc in tcl:
+                    try: args = json.loads(tc["function"]["arguments"])
+                    except: args = {}
+                    parsed.append((tc["function"]["name"], args))
+                offered = {t["function"]["name"] for t in tls}
+                if any(n not in offered for n, _ in parsed):
+                    tls = tools()  # the selection guessed wrong: offer everything from the next round on
+                keys = [guard.key(*c) for c in parsed]
+                loop = guard.check(keys)
+                if loop:
+                    print(f"  🔄 LOOP DETECTED ({loop})"); return res("loop", rnd)
+                fps = [footprint(wb, *c) for c in parsed]
+                # re-reads of ranges nothing has written since are answered from the cache
+                hit = guard.lookup(keys, fps, {i for i, tc in enumerate(tcl) if tc["id"] not in early})
+                if guard.idle >= MAX_SAME_REPEATS:
+                    print(f"  🔄 LOOP DETECTED (re-reads)"); return res("loop", rnd)
+                todo = [i for i, tc in enumerate(tcl) if tc["id"] not in early and i not in hit]
+                done = run_calls([parsed[i] for i in todo], lambda c: traced_exec(wb, *c, rnd),
+                                 [fps[i] for i in todo], TOOL_WORKERS)
+                results = {**hit, **dict(zip(todo, done))}
+                if hit: rs.set(cached=len(hit))
+
+                for i, tc in enumerate(tcl):
+                    fn = tc["function"]["name"]
+                    fa = tc["function"]["arguments"]
+                    tid = tc["id"]
+                    total_tc += 1
+                    result = early.pop(tid) if tid in early else results[i]
+                    if i not in hit: guard.record(keys[i], fps[i], result)
+                    with TRACER.span("json.dumps", "serialize", tool=fn) as ss:
+                        rstr = json.dumps(result, ensure_ascii=False)
+                        ss.set(bytes=len(rstr.encode("utf-8")))
+                    short_a = fa if len(fa)<70 else fa[:67]+"..."
+                    short_r = rstr if len(rstr)<90 else rstr[:87]+"..."
+                    print(f"    🔧 {fn}({short_a}) → {short_r}")
+                    msgs.append({"role":"tool","content":rstr,"tool_call_id":tid})
+                continue
+
+            content = msg.get("content","")
+            if not content:
+                print(" ⚠️ EMPTY")
+                return res("empty", rnd)
+            print(f" 💬 done")
+            print(f"  {'─'*50}")
+            for l in content.split("\n"): print(f"    {l}")
+            print(f"  {'─'*50}")
+            print(f"  ✅ {rnd} rounds, {total_tc} tool calls")
+            return res("ok", rnd, response=content)
 
     print(f"  ⚠️ MAX ROUNDS")
-    return {"stop":"max_rounds","rounds":max_rounds,"tools":total_tc}
+    return res("max_rounds", max_rounds)
 
 
 # ── MAIN ────────────────────────────────────────────────────────────
 if __name__ == "__main__":
-    print("🧪 Z.AI API Test (simplified)")
-    print(f"   Model: {MODEL}, Max rounds: {MAX_ROUNDS}\n")
-
-    # Connectivity check
-    print("📡 API check...", end="", flush=True)
-    try:
-        r = requests.post(f"{API_BASE}/chat/completions",
-            json={"model":MODEL,"messages":[{"role":"user","content":"test"}],"max_tokens":5},
-            headers={"Authorization":f"Bearer {API_KEY}","Content-Type":"application/json"}, timeout=30)
-        if r.status_code == 200: print(" ✅")
-        else: print(f" ❌ {r.status_code}"); sys.exit(1)
-    except Exception as e: print(f" ❌ {e}"); sys.exit(1)
+    ap = argparse.ArgumentParser(description="Z.AI API test scenarios")
+    ap.add_argument("--workers", type=int, default=4, help="scenarios run concurrently")
+    ap.add_argument("--prompts", help="JSONL with extra scenarios: {label, prompt, max_rounds}")
+    ap.add_argument("--no-check", action="store_true", help="skip the connectivity check")
+    ap.add_argument("--base", help="API base URL (default: z.ai)")
+    ap.add_argument("--cassette", help="directory of recorded responses; misses are recorded live")
+    ap.add_argument("--replay", action="store_true", help="serve --cassette from a local stub, no network")
+    ap.add_argument("--latency", type=float, default=0.0, help="stub latency in seconds (with --replay)")
+    ap.add_argument("--stream", action="store_true", help="stream completions (SSE) and report TTFT")
+    ap.add_argument("--all-tools", action="store_true", help="always send every tool schema")
+    ap.add_argument("--tool-workers", type=int, default=TOOL_WORKERS, help="parallel tool calls per round (1 = serial)")
+    ap.add_argument("--trace", metavar="PREFIX", help="write PREFIX.jsonl and PREFIX.trace.json (chrome://tracing) spans")
+    ap.add_argument("--budget", type=int, default=HISTORY_BUDGET, help="prompt token budget before compaction (0 = off)")
+    ap.add_argument("--workbook", help=".xlsx or CSV file the --prompts scenarios start from")
+    ap.add_argument("--sheet", action="append", help="with --workbook: load only this sheet (repeatable); for a CSV, the name it loads as")
+    opts = ap.parse_args()
+    HISTORY_BUDGET = opts.budget
+    TOOL_SUBSET = not opts.all_tools
+    TOOL_WORKERS = opts.tool_workers
+    STREAM = opts.stream
+    TRACER.enabled = bool(opts.trace)
+    if opts.base: API_BASE = opts.base.rstrip("/")
+    if opts.cassette and opts.replay:
+        stub = StubServer(Cassette(opts.cassette), latency=opts.latency, chunk_delay=opts.latency/20).start()
+        API_BASE, opts.no_check = stub.url, True
+        LIMITER = RateLimiter(rate=1e6, burst=1e6, in_flight=64)  # local stub, no quota to respect
+        print(f"🗄️ Replaying {len(stub.cassette)} recorded response(s) from {stub.url}")
+    elif opts.cassette:
+        CASSETTE = Cassette(opts.cassette)
 
-    results = {}
+    print("🧪 Z.AI API Test (simplified)")
+    print(f"   Model: {MODEL}, Max rounds: {MAX_ROUNDS}, Workers: {opts.workers}\n")
 
-    # TEST 1: Build small random table + pivot (limit to 10 rows for speed)
+    # Connectivity check (also opens the pooled connection the scenarios reuse)
+    if not opts.no_check:
+        print("📡 API check...", end="", flush=True)
+        try:
+            with LIMITER:
+                r = SESSION.post(f"{API_BASE}/chat/completions",
+                    json={"model":MODEL,"messages":[{"role":"user","content":"test"}],"max_tokens":5},
+                    headers={"Authorization":f"Bearer {API_KEY}","Content-Type":"application/json"}, timeout=10)
+            if r.status_code == 200 or is_rate_limited(r): print(" ✅")
+            else: print(f" ❌ {r.status_code}"); sys.exit(1)
+        except Exception as e: print(f" ❌ {e}"); sys.exit(1)
+
+    # TEST 1 + 2: Build small random table + pivot (limit to 10 rows for speed), then prettify it
     wb1 = VWB()
-    results["T1: tabela+pivot"] = run(
-        "Stwórz małą tabelę (5 wierszy danych + nagłówek) z kolumnami: Produkt, Kategoria, Ilość, Cena. "
-        "Oblicz kolumnę Wartość (Ilość*Cena). Następnie stwórz tabelę przestawną podsumowującą Wartość wg Kategorii.",
-        wb1, "Mała tabela + pivot (5 wierszy)", max_rounds=20)
-
-    # TEST 2: Prettify
-    if results.get("T1: tabela+pivot",{}).get("stop") == "ok":
-        results["T2: ładniejsza"] = run("Sformatuj tabelę — pogrubiony nagłówek, obramowanie, format walutowy dla Cena i Wartość.",
-            wb1, "Upiększenie", max_rounds=15)
+    def t1_t2():
+        res = {"T1: tabela+pivot": run(
+            "Stwórz małą tabelę (5 wierszy danych + nagłówek) z kolumnami: Produkt, Kategoria, Ilość, Cena. "
+            "Oblicz kolumnę Wartość (Ilość*Cena). Następnie stwórz tabelę przestawną podsumowującą Wartość wg Kategorii.",
+            wb1, "Mała tabela + pivot (5 wierszy)", max_rounds=20)}
+        if res["T1: tabela+pivot"].get("stop") == "ok":
+            res["T2: ładniejsza"] = run("Sformatuj tabelę — pogrubiony nagłówek, obramowanie, format walutowy dla Cena i Wartość.",
+                wb1, "Upiększenie", max_rounds=15)
+        return res
 
     # TEST 3: Move pivot table (the key test!)
     wb3 = VWB()
@@ -375,21 +787,54 @@ if __name__ == "__main__":
         wb3.sheets["Arkusz1"][(r, 2)] = ["Wartość",100,200,300,150,250][r-1]
     wb3.pivots["PT1"] = {"source":"'Arkusz1'!A1:B6","dest_sheet":"Arkusz1","dest_cell":"D1",
                          "row_fields":["Produkt"],"value_fields":["Wartość"]}
-    results["T3: przenieś pivot"] = run(
-        "Na arkuszu Arkusz1 mam dane w A1:B6 i tabelę przestawną PT1 w D1. "
-        "Przenieś tabelę przestawną na osobny arkusz i usuń puste wiersze 8-20 z danych.",
-        wb3, "Przeniesienie pivot + delete_rows", max_rounds=20)
+    def t3():
+        return {"T3: przenieś pivot": run(
+            "Na arkuszu Arkusz1 mam dane w A1:B6 i tabelę przestawną PT1 w D1. "
+            "Przenieś tabelę przestawną na osobny arkusz i usuń puste wiersze 8-20 z danych.",
+            wb3, "Przeniesienie pivot + delete_rows", max_rounds=20)}
 
     # TEST 4: Empty workbook edge case
-    wb4 = VWB()
-    results["T4: pusty"] = run("Podsumuj dane w tym arkuszu", wb4, "Pusty arkusz", max_rounds=10)
+    def t4():
+        return {"T4: pusty": run("Podsumuj dane w tym arkuszu", VWB(), "Pusty arkusz", max_rounds=10)}
+
+    jobs = [("T1+T2", t1_t2), ("T3", t3), ("T4", t4)]
+    base = VWB()  # prompt-file scenarios each run on a copy-on-write fork of it
+    if opts.workbook:
+        t0 = time.perf_counter()
+        names = load_workbook(base, opts.workbook, opts.sheet)
+        print(f"📂 {opts.workbook}: {', '.join(f'{n} ({len(base.sheets[n])})' for n in names)} "
+              f"in {time.perf_counter()-t0:.1f}s")
+    if opts.prompts:
+        with open(opts.prompts, encoding="utf-8") as f:
+            for i, line in enumerate(l for l in f if l.strip()):
+                sc = json.loads(line)
+                lb = sc.get("label") or f"P{i+1}"
+                if lb in {j[0] for j in jobs}: lb = f"{lb} #{i+1}"  # results are keyed by label
+                jobs.append((lb, lambda sc=sc, lb=lb: {lb: run(sc["prompt"], base.fork(), lb, max_rounds=sc.get("max_rounds", MAX_ROUNDS))}))
+
+    t0 = time.perf_counter()
+    results = {}
+    for lb, res in run_many(jobs, workers=opts.workers).items():
+        results.update(res or {lb: None})
+    print(f"\n  ⏱️ {len(jobs)} scenario(s) in {time.perf_counter()-t0:.1f}s")
+    if CASSETTE is not None:
+        print(f"  🗄️ cassette: {CASSETTE.hits} hit(s), {CASSETTE.misses} recorded")
+    if opts.trace:
+        TRACER.export_jsonl(opts.trace + ".jsonl")
+        TRACER.export_chrome(opts.trace + ".trace.json")
+        TRACER.print_report()
+        TRACER.print_report(key=lambda ev: ("round", f"R{ev['args']['round']}") if ev["cat"] == "round" else None)
+        print(f"  🧵 trace: {opts.trace}.jsonl, {opts.trace}.trace.json")
 
     # Summary
     print(f"\n{'='*60}\n  📊 PODSUMOWANIE\n{'='*60}")
     for name, res in results.items():
         if res:
             st = "✅" if res["stop"]=="ok" else ("⚠️" if res["stop"] in ("max_rounds","loop") else "❌")
-            print(f"  {st} {name}: stop={res['stop']}, rounds={res['rounds']}, tools={res['tools']}")
+            tt = sorted(t["ttft"] for t in res.get("timings",[]) if t["ttft"] is not None)
+            ttft = f", ttft p50={tt[len(tt)//2]:.2f}s" if tt else ""
+            saved = f", saved≈{res['tokens_saved']}tok" if res.get("tokens_saved") else ""
+            print(f"  {st} {name}: stop={res['stop']}, rounds={res['rounds']}, tools={res['tools']}{ttft}{saved}")
         else:
             print(f"  ❌ {name}: brak wyniku")
 
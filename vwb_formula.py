@@ -0,0 +1,889 @@
+"""
+Formula engine for the VWB virtual workbook (test_api.py)
+Cell dependency graph with incremental, topologically ordered recalculation
+"""
+import operator, re, threading
+from contextlib import contextmanager
+
+from vwb_store import shift_row, shift_span
+
+ALL = 1 << 30  # row bound of whole-column references (A:A)
+
+
+class Err(str):
+    """Excel error value; a str so results serialise unchanged."""
+    __slots__ = ()
+
+
+DIV0, VALUE, NA, REF, NAME, NUM, CIRC = map(Err, ("#DIV/0!", "#VALUE!", "#N/A", "#REF!", "#NAME?", "#NUM!", "#CIRC!"))
+_NUM = {int, float}
+
+# ── lexer / parser ──
+_TOKEN = re.compile(r"""
+  (?P<ws>\s+)
+| (?P<str>"(?:[^"]|"")*")
+| (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+| (?P<func>[A-Za-z_][\w.]*)\s*\(
+| (?P<ref>(?:(?P<sh>'(?:[^']|'')+'|[^\W\d][\w.]*)!)?
+    (?:(?P<a>\$?[A-Za-z]{1,3}\$?\d+)(?::(?P<b>\$?[A-Za-z]{1,3}\$?\d+))?(?![\w(])
+      |(?P<ca>\$?[A-Za-z]{1,3}):(?P<cb>\$?[A-Za-z]{1,3})(?![\w(])))
+| (?P<bool>TRUE|FALSE)(?![\w(])
+| (?P<err>\#(?:REF!|DIV/0!|N/A|VALUE!|NAME\?|NUM!))
+| (?P<op><>|<=|>=|[-+*/^&%=<>(),;])
+""", re.X | re.I)
+_CELL = re.compile(r"(\$?)([A-Za-z]{1,3})(\$?)(\d+)")
+
+
+def _lex(text):
+    pos, out = 0, []
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if not m: raise ValueError(f"Unexpected '{text[pos]}' in formula at {pos}")
+        out.append(m)
+        pos = m.end()
+    return out
+
+
+def _col(s):
+    n = 0
+    for ch in s.upper(): n = n * 26 + ord(ch) - 64
+    return n
+
+
+def _letters(c):
+    s = ""
+    while c > 0:
+        c -= 1; s = chr(c % 26 + 65) + s; c //= 26
+    return s
+
+
+def _cellref(s):
+    ra, col, ca, row = _CELL.fullmatch(s).groups()
+    return int(row), _col(col), bool(ra), bool(ca)
+
+
+def _sheetname(m):
+    sh = m.group("sh")
+    if sh and sh.startswith("'"): sh = sh[1:-1].replace("''", "'")
+    return sh
+
+
+def parse(text):
+    """AST of a formula (the leading ``=`` is optional); ValueError on bad syntax.
+
+    Nodes are tuples: ``("num", v)``, ``("str", s)``, ``("bool", b)``, ``("err", e)``,
+    ``("ref", sheet, (r, c, row_abs, col_abs))``, ``("rng", sheet, corner, corner)``,
+    ``("fn", NAME, [args])``, ``("op", op, a, b)``, ``("neg", a)``, ``("pct", a)``.
+    """
+    toks = [m for m in _lex(text[1:] if text.startswith("=") else text) if m.lastgroup != "ws"]
+    pos = 0
+
+    def peek():
+        return toks[pos] if pos < len(toks) else None
+
+    def isop(*ops):
+        m = peek()
+        return m is not None and m.lastgroup == "op" and m.group() in ops
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return toks[pos - 1]
+
+    def binary(ops, sub):
+        def level():
+            a = sub()
+            while isop(*ops): a = ("op", take().group(), a, sub())
+            return a
+        return level
+
+    def unary():
+        if isop("-"): take(); return ("neg", unary())
+        if isop("+"): take(); return unary()
+        a = primary()
+        while isop("%"): take(); a = ("pct", a)
+        return a
+
+    def primary():
+        m = peek()
+        if m is None: raise ValueError("Unexpected end of formula")
+        k = m.lastgroup
+        take()
+        if k == "num": return ("num", int(m.group()) if m.group().isdigit() else float(m.group()))
+        if k == "str": return ("str", m.group()[1:-1].replace('""', '"'))
+        if k == "bool": return ("bool", m.group().upper() == "TRUE")
+        if k == "err": return ("err", Err(m.group().upper()))
+        if k == "ref":
+            sh = _sheetname(m)
+            if m.group("ca"):
+                ca1, ca2 = m.group("ca"), m.group("cb")
+                return ("rng", sh, (1, _col(ca1.lstrip("$")), True, ca1.startswith("$")),
+                        (ALL, _col(ca2.lstrip("$")), True, ca2.startswith("$")))
+            a = _cellref(m.group("a"))
+            return ("rng", sh, a, _cellref(m.group("b"))) if m.group("b") else ("ref", sh, a)
+        if k == "func":
+            name, args = m.group("func").upper(), []
+            while not isop(")"):
+                args.append(expr())
+                if isop(",", ";"): take()
+                elif not isop(")"): raise ValueError(f"Expected ',' or ')' in {name}()")
+            take()
+            lo, hi = _ARITY.get(name, (1, 255) if name in _AGG else (0, 255))
+            if not lo <= len(args) <= hi: raise ValueError(f"{name}() takes {lo} to {hi} arguments, got {len(args)}")
+            return ("fn", name, args)
+        if k == "op" and m.group() == "(":
+            a = expr()
+            if not isop(")"): raise ValueError("Missing ')'")
+            take()
+            return a
+        raise ValueError(f"Unexpected '{m.group()}' in formula")
+
+    power = binary(("^",), unary)
+    term = binary(("*", "/"), power)
+    arith = binary(("+", "-"), term)
+    concat = binary(("&",), arith)
+    expr = binary(("=", "<>", "<", ">", "<=", ">="), concat)
+    tree = expr()
+    if pos != len(toks): raise ValueError(f"Unexpected '{toks[pos].group()}' in formula")
+    return tree
+
+
+def shift(text, dr, dc):
+    """Formula text as filled ``dr`` rows / ``dc`` columns away (relative refs move)."""
+    if not dr and not dc: return text
+    out = []
+    for m in _lex(text):
+        if m.lastgroup != "ref":
+            out.append(m.group()); continue
+        g1, g2 = ("ca", "cb") if m.group("ca") else ("a", "b")
+        parts = [_move(m.group(g), dr, dc) for g in (g1, g2) if m.group(g)]
+        out.append(m.group()[:m.start(g1) - m.start()] + ("#REF!" if None in parts else ":".join(parts)))
+    return "".join(out)
+
+
+def _move(ref, dr, dc):
+    # one cell ("$A1") or column ("B") reference moved by the offset, None if off the sheet
+    if ref.lstrip("$").isalpha():
+        c = _col(ref.lstrip("$")) + (0 if ref.startswith("$") else dc)
+        return None if c < 1 else ("$" if ref.startswith("$") else "") + _letters(c)
+    r, c, ra, ca = _cellref(ref)
+    return _corner(r if ra else r + dr, c if ca else c + dc, ra, ca)
+
+
+def _corner(r, c, ra, ca):
+    return None if r < 1 or c < 1 else f"{'$' if ca else ''}{_letters(c)}{'$' if ra else ''}{r}"
+
+
+def _edit(text, fn):
+    # text with each reference token m replaced by fn(m) unless that is None; None if none was
+    out, hit = [], False
+    for m in _lex(text):
+        new = fn(m) if m.lastgroup == "ref" else None
+        out.append(m.group() if new is None else new)
+        hit = hit or new is not None
+    return "".join(out) if hit else None
+
+
+def _quote(name):
+    # a sheet name as written before "!"
+    return name if re.fullmatch(r"[^\W\d]\w*", name) else "'" + name.replace("'", "''") + "'"
+
+
+# ── values ──
+class _Rng:
+    __slots__ = ("sheet", "r1", "c1", "r2", "c2")
+
+    def __init__(self, sheet, r1, c1, r2, c2):
+        self.sheet, self.r1, self.c1, self.r2, self.c2 = sheet, r1, c1, r2, c2
+
+    def bounds(self):
+        # clamped to the used range: nothing past it but blanks
+        bx = self.sheet.bbox()
+        if bx is None: return self.r1, self.c1, self.r1 - 1, self.c1 - 1
+        return self.r1, self.c1, min(self.r2, bx[2]), min(self.c2, bx[3])
+
+    def cols(self):
+        r1, c1, r2, c2 = self.bounds()
+        return [self.sheet.read_col(c, r1, r2) for c in range(c1, c2 + 1)]
+
+
+def _fix(v):
+    if type(v) is float:
+        if v != v or v in (float("inf"), float("-inf")): return NUM
+        if v.is_integer() and abs(v) < 2 ** 53: return int(v)
+    return v
+
+
+def _scalar(v):
+    if type(v) is _Rng:
+        if v.r1 == v.r2 and v.c1 == v.c2: return v.sheet.cell(v.r1, v.c1)
+        return VALUE
+    return v
+
+
+def _num(v):
+    t = type(v)
+    if t is int or t is float: return v
+    if v is None: return 0
+    if t is bool: return int(v)
+    if t is Err: return v
+    if t is _Rng: return _num(_scalar(v))
+    if t is str:
+        try: return _fix(float(v))
+        except ValueError: return VALUE
+    return VALUE
+
+
+def _bool(v):
+    v = _scalar(v)
+    t = type(v)
+    if v is None: return False
+    if t is bool or t is Err: return v
+    if t is int or t is float: return v != 0
+    if t is str and v.upper() in ("TRUE", "FALSE"): return v.upper() == "TRUE"
+    return VALUE
+
+
+def _text(v):
+    v = _scalar(v)
+    if v is None: return ""
+    if type(v) is bool: return "TRUE" if v else "FALSE"
+    if type(v) is float: v = _fix(v)
+    return v if type(v) is Err else str(v)
+
+
+def _arith(op, x, y):
+    x = _num(x)
+    if type(x) is Err: return x
+    y = _num(y)
+    if type(y) is Err: return y
+    try: r = op(x, y)
+    except ZeroDivisionError: return DIV0
+    except (OverflowError, ValueError): return NUM
+    if type(r) is complex: return NUM
+    return _fix(r)
+
+
+def _ckey(v, other):
+    # Excel ordering: numbers < text < booleans; a blank compares as the other side's zero value
+    t = type(v)
+    if v is None:
+        t = type(other)
+        return (1, "") if t is str else (2, False) if t is bool else (0, 0)
+    if t is bool: return (2, v)
+    if t is str: return (1, v.casefold())
+    return (0, v)
+
+
+def _compare(op, x, y):
+    x, y = _scalar(x), _scalar(y)
+    if type(x) is Err: return x
+    if type(y) is Err: return y
+    return op(_ckey(x, y), _ckey(y, x))
+
+
+_OPS = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv, "^": operator.pow}
+_CMP = {"=": operator.eq, "<>": operator.ne, "<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge}
+
+
+# ── functions ──
+def _nums(args, strict=True):
+    """Numbers in the arguments; a range contributes only its numeric cells.
+
+    Column slices are filtered with one C-level pass each, so a function over
+    a 100k-row range costs a few milliseconds. With ``strict`` the first error
+    value is returned instead.
+    """
+    out = []
+    for a in args:
+        if type(a) is _Rng:
+            for vals in a.cols():
+                ts = set(map(type, vals))
+                if Err in ts and strict: return next(v for v in vals if type(v) is Err)
+                out += vals if ts <= _NUM else [v for v in vals if type(v) in _NUM]
+        elif type(a) is Err:
+            if strict: return a
+        elif a is not None:
+            v = _num(a)
+            if type(v) is not Err: out.append(v)
+            elif strict: return v
+    return out
+
+
+def _sum(args):
+    n = _nums(args)
+    return n if type(n) is Err else _fix(sum(n))
+
+
+def _average(args):
+    n = _nums(args)
+    if type(n) is Err: return n
+    return _fix(sum(n) / len(n)) if n else DIV0
+
+
+def _count(args):
+    return len(_nums(args, strict=False))
+
+
+def _min(args):
+    n = _nums(args)
+    return n if type(n) is Err else min(n, default=0)
+
+
+def _max(args):
+    n = _nums(args)
+    return n if type(n) is Err else max(n, default=0)
+
+
+def _lkey(v):
+    t = type(v)
+    if t is bool: return (2, v)
+    if t is int or t is float: return (0, v)
+    if t is str: return (1, v.casefold())
+    return None
+
+
+_AGG = {"SUM": _sum, "AVERAGE": _average, "COUNT": _count, "MIN": _min, "MAX": _max}
+_ARITY = {"IF": (2, 3), "VLOOKUP": (3, 4)}
+
+
+def _bind(spec, dr, dc):
+    # template references -> (sheet, r1, c1, r2, c2) of one filled cell; off-sheet ones read nothing
+    out = []
+    for sh, (r1, c1, ra1, ca1), (r2, c2, ra2, ca2) in spec:
+        if not ra1: r1 += dr
+        if not ca1: c1 += dc
+        if not ra2: r2 += dr
+        if not ca2: c2 += dc
+        if r1 >= 1 and c1 >= 1 and r2 >= 1 and c2 >= 1:
+            out.append((sh, r1, c1, r2, c2) if r1 <= r2 and c1 <= c2 else
+                       (sh, min(r1, r2), min(c1, c2), max(r1, r2), max(c1, c2)))
+    return out
+
+
+class _Formula:
+    __slots__ = ("sheet", "r", "c", "src", "dr", "dc", "fn", "refs", "dead")
+
+    def __init__(self, sheet, r, c, src, dr, dc, fn):
+        self.sheet, self.r, self.c, self.src, self.dr, self.dc, self.fn = sheet, r, c, src, dr, dc, fn
+        self.refs, self.dead = (), False
+
+    def text(self):
+        return shift(self.src, self.dr, self.dc)
+
+
+class Engine:
+    """Formulas of one workbook and the cells they depend on.
+
+    ``sheets`` is the workbook's live name -> Sheet dict. Sheets that host or
+    feed a formula get a ``watch`` callback that only queues the touched
+    rectangle; ``flush()`` (run by ``VWB.exec`` after each tool) drops
+    formulas that were overwritten with plain values and recomputes the
+    formulas depending on the queued cells, each once, in topological order.
+    Formulas on a cycle evaluate to ``#CIRC!``. After the first ``mark()``
+    formula additions and removals are journaled so ``rewind()`` can undo
+    (and, from an earlier mark, redo) them.
+    Structural edits (row inserts/deletes, sorts, copies, sheet renames and
+    deletes) go through the engine, which moves formulas with their cells and
+    rewrites references as Excel does. The engine's own writes are not
+    queued, and formula results are stored in the sheet, so reads see plain values.
+    """
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self.cells = {}     # Sheet -> {(r, c): _Formula}
+        self.point = {}     # Sheet -> {(r, c): {formulas reading that cell}}
+        self.span = {}      # Sheet -> {col: [(r1, r2, formula)]} for range references
+        self.pending = []   # (Sheet, r1, c1, r2, c2) written since the last flush
+        self._hooked = set()
+        self._lock = threading.RLock()
+        self._busy = None   # thread id while the engine itself writes results
+        self._memo = {}     # exact VLOOKUP indexes, valid for one recalculation
+        self.journal = None # (previous, "add" | "drop", [formulas], depth) since the first mark()
+
+    def __len__(self):
+        return sum(map(len, self.cells.values()))
+
+    def formula(self, sheet, r, c):
+        f = self.cells.get(sheet, {}).get((r, c))
+        return f.text() if f else None
+
+    def set(self, sheet, r, c, text, r2=None, c2=None):
+        """Put ``text`` into (r, c), filled relatively over the rectangle to
+        (r2, c2) if given; returns (value at (r, c), cells filled)."""
+        tree = parse(text)
+        r2, c2 = r if r2 is None else r2, c if c2 is None else c2
+        with self._lock:
+            self.flush()
+            self._drop(sheet, min(r, r2), min(c, c2), max(r, r2), max(c, c2))
+            self._hook(sheet)
+            spec = []
+            fn = self._template(tree, sheet, spec)
+            new = []
+            cells = self.cells.setdefault(sheet, {})
+            for rr in range(min(r, r2), max(r, r2) + 1):
+                for cc in range(min(c, c2), max(c, c2) + 1):
+                    f = cells[rr, cc] = _Formula(sheet, rr, cc, text, rr - r, cc - c, fn)
+                    f.refs = _bind(spec, rr - r, cc - c)
+                    self._register(f)
+                    new.append(f)
+            self._log("add", new)
+            self._recalc(new)
+        return sheet.cell(r, c), len(new)
+
+
+    def mark(self):
+        """Restore point for ``rewind()``; starts the journal."""
+        with self._lock:
+            if self.journal is None: self.journal = (None, None, (), 0)
+            return self.journal
+
+    def rewind(self, token):
+        """Bring the formulas to where they were when ``mark()`` returned ``token``.
+
+        The journal is a linked list shared with the marks, like VWB's exec
+        journal: changes since the common ancestor are undone, then those on
+        the way to ``token`` replayed, so a mark taken after an earlier
+        rewind's point is reachable too (redo). Only the formulas come back;
+        their values are restored with the sheets, so nothing is recomputed
+        and queued changes are discarded.
+        """
+        with self._lock:
+            a, b, redo = self.journal, token, []
+            if a is None: raise ValueError("Snapshot is not from this workbook")
+            while a[3] > b[3]: self._undo(a); a = a[0]
+            while b[3] > a[3]: redo.append(b); b = b[0]
+            while a is not b:
+                if a[0] is None: raise ValueError("Snapshot is not from this workbook")
+                self._undo(a); redo.append(b)
+                a, b = a[0], b[0]
+            for _, op, fs, _ in reversed(redo): self._apply(op == "add", fs)
+            self.journal = token
+            self.pending = []
+
+    def fork(self, sheets, mapping):
+        """Engine with the same formulas over ``sheets`` (``mapping``: old Sheet -> new Sheet).
+
+        Templates are recompiled per (sheet, text), not per cell; values are
+        not recomputed, the forked sheets already hold them.
+        """
+        eng = Engine(sheets)
+        with self._lock:
+            groups = {}
+            for sh, cells in self.cells.items():
+                if sh in mapping:
+                    for f in cells.values(): groups.setdefault((sh, f.src), []).append(f)
+        for (sh, src), fs in groups.items():
+            host, spec = mapping[sh], []
+            fn = eng._template(parse(src), host, spec)
+            eng._hook(host)
+            cells = eng.cells.setdefault(host, {})
+            for f in fs:
+                g = cells[f.r, f.c] = _Formula(host, f.r, f.c, src, f.dr, f.dc, fn)
+                g.refs = _bind(spec, f.dr, f.dc)
+                eng._register(g)
+        return eng
+
+    def flush(self):
+        if not self.pending: return
+        with self._lock:
+            rects, self.pending = self.pending, []
+            seeds = set()
+            for s, r1, c1, r2, c2 in rects:
+                self._drop(s, r1, c1, r2, c2)
+                seeds |= self._dependents(s, r1, c1, r2, c2)
+            self._recalc(seeds)
+
+    # ── structure ──
+    def shift_rows(self, sheet, at, n):
+        """Insert (n > 0) or delete (n < 0) ``abs(n)`` rows of ``sheet`` at row ``at``.
+
+        As in Excel, formulas on moved rows move with them and references to
+        the sheet, from any sheet, follow their cells: ranges grow or shrink,
+        references to deleted rows become ``#REF!``, whole columns stay. A
+        fill whose relative offsets survive keeps one template, so moving
+        it costs no recompilation per cell.
+        """
+        with self._lock:
+            self.flush()
+            with self._quiet():
+                if n > 0: sheet.insert_rows(at, n)
+                else: sheet.delete_rows(at, -n)
+            gone = lambda a, b: n < 0 and at <= a and b < at - n
+            new, seeds = self._rebase(sheet, lambda x: None if gone(x, x) else shift_row(x, at, n),
+                                      lambda a, b: None if gone(a, b) else shift_span(a, b, at, n))
+            if n < 0: seeds |= self._dependents(sheet, at, 1, ALL, ALL)  # whole columns lost rows
+            self._recalc(seeds)
+
+    def take_rows(self, sheet, r1, c1, r2, c2, idx):
+        """``sheet.take_rows`` (a sort): formulas go with their rows and, as in
+        Excel, their relative references move as if copied there."""
+        with self._lock:
+            self.flush()
+            with self._quiet(): sheet.take_rows(r1, c1, r2, c2, idx)
+            to = {r1 + j: r1 + i for i, j in enumerate(idx)}
+            old = [f for (r, c), f in self.cells.get(sheet, {}).items() if r1 <= r <= r2 and c1 <= c <= c2]
+            cache = {}
+            new = [self._place(cache, sheet, to[f.r], f.c, f.src, f.dr + to[f.r] - f.r, f.dc) for f in old if f.r in to]
+            self._swap(old, new)
+            self._recalc(set(new) | self._dependents(sheet, r1, c1, r2, c2))
+
+    def copy(self, src, r1, c1, r2, c2, dst, r, c):
+        """Copy the values and formulas of a rectangle of ``src`` to (r, c) of
+        ``dst``; relative references move with the cells, as Excel pastes."""
+        with self._lock:
+            self.flush()
+            cols = [src.read_col(cc, r1, r2) for cc in range(c1, c2 + 1)]
+            fs = [f for (rr, cc), f in self.cells.get(src, {}).items() if r1 <= rr <= r2 and c1 <= cc <= c2]
+            with self._quiet():
+                for i, col in enumerate(cols): dst.write_col(c + i, r, col)
+            dr, dc, r2, c2 = r - r1, c - c1, r + r2 - r1, c + c2 - c1
+            old = [f for (rr, cc), f in self.cells.get(dst, {}).items() if r <= rr <= r2 and c <= cc <= c2]
+            self._hook(dst)
+            cache = {}
+            new = [self._place(cache, dst, f.r + dr, f.c + dc, f.src, f.dr + dr, f.dc + dc) for f in fs]
+            self._swap(old, new)
+            self._recalc(set(new) | self._dependents(dst, r, c, r2, c2))
+
+    def rename(self, old, new):
+        """Rewrite references to sheet ``old`` in formula text after it became ``new``."""
+        name = _quote(new)
+        renamed = lambda m: name + m.group()[m.end("sh") - m.start():] \
+            if (_sheetname(m) or "").casefold() == old.casefold() else None
+        with self._lock:
+            was, now = [], []
+            for (host, src, _), fs in self._groups().items():
+                text = _edit(src, renamed)
+                if text is None: continue
+                for f in fs:
+                    g = _Formula(host, f.r, f.c, text, f.dr, f.dc, f.fn)  # same sheets: same template
+                    g.refs = f.refs
+                    was.append(f); now.append(g)
+            self._swap(was, now)
+
+    def forget(self, sheet, name=None):
+        """Drop every formula hosted on a deleted sheet; given its ``name``,
+        references to it from other sheets become ``#REF!``."""
+        with self._lock:
+            fs = list(self.cells.pop(sheet, {}).values())
+            for f in fs: self._unregister(f)
+            self._log("drop", fs)
+            if name is None: return
+            dead = lambda m: "#REF!" if (_sheetname(m) or "").casefold() == name.casefold() else None
+            old, new, cache = [], [], {}
+            for (host, src, _), group in self._groups().items():
+                text = _edit(src, dead)
+                if text is None: continue
+                old += group
+                new += [self._place(cache, host, f.r, f.c, text, f.dr, f.dc) for f in group]
+            self._swap(old, new)
+            self._recalc(new)
+
+    def _rebase(self, sheet, row, rows):
+        # Formulas hosted on or reading ``sheet`` after its rows moved: row(r) is where
+        # row r went, rows(a, b) where a range went (None: deleted). Returns the new
+        # formulas and the set of those whose value may have changed.
+        cache, old, new, changed = {}, [], [], set()
+        for (host, src, r0), fs in self._groups().items():
+            toks = _lex(src)
+            refs = [(i, m, _cellref(m.group("a")), m.group("b") and _cellref(m.group("b")),
+                     self._sheet(_sheetname(m), host) is sheet)
+                    for i, m in enumerate(toks) if m.lastgroup == "ref" and not m.group("ca")]
+            if host is not sheet and not any(x[4] for x in refs): continue
+            # each reference's row as an offset from the formula (relative) or absolute;
+            # equal keys share a template, and the unchanged key is the current one
+            at = lambda x: x[0] if x[2] else x[0] - r0
+            base = tuple((at(a), at(b)) if b else at(a) for _, _, a, b, _ in refs)
+            moved = {}
+            for f in fs:
+                hr = row(f.r) if host is sheet else f.r
+                if hr is None:  # its row was deleted
+                    old.append(f); continue
+                key = []
+                for _, _, a, b, hit in refs:
+                    x = a[0] if a[2] else a[0] + f.dr
+                    if not b:
+                        x = row(x) if hit else x
+                        key.append(None if x is None else x if a[2] else x - hr)
+                        continue
+                    y = b[0] if b[2] else b[0] + f.dr
+                    s = (rows(min(x, y), max(x, y)) if hit else (min(x, y), max(x, y)))
+                    if s is None: key.append(None); continue
+                    x, y = s if x <= y else s[::-1]
+                    key.append((x if a[2] else x - hr, y if b[2] else y - hr))
+                key = tuple(key)
+                if key != base or hr != f.r: moved.setdefault(key, []).append((f, hr))
+            for key, fhs in moved.items():
+                (g0, h0), text = fhs[0], src
+                if key != base:
+                    out = [m.group() for m in toks]
+                    for (i, m, a, b, _), k in zip(refs, key):
+                        ca = a[1] if a[3] else a[1] + g0.dc
+                        if k is None: pass
+                        elif b: k = [_corner(k[0] if a[2] else k[0] + h0, ca, a[2], a[3]),
+                                   _corner(k[1] if b[2] else k[1] + h0, b[1] if b[3] else b[1] + g0.dc, b[2], b[3])]
+                        else: k = [_corner(k if a[2] else k + h0, ca, a[2], a[3])]
+                        out[i] = "#REF!" if k is None or None in k else m.group()[:m.start("a") - m.start()] + ":".join(k)
+                    text = "".join(out)
+                for f, hr in fhs:
+                    g = (self._place(cache, host, hr, f.c, text, hr - h0, f.c - g0.c) if key != base else
+                         self._place(cache, host, hr, f.c, src, f.dr + hr - f.r, f.dc))
+                    old.append(f); new.append(g)
+                    if key != base: changed.add(g)
+        self._swap(old, new)
+        return new, changed
+
+    def _groups(self):
+        # formulas sharing a template: (host, text, origin row) -> [formulas]
+        out = {}
+        for host, cells in self.cells.items():
+            for f in cells.values(): out.setdefault((host, f.src, f.r - f.dr), []).append(f)
+        return out
+
+    def _place(self, cache, host, r, c, src, dr, dc):
+        # a formula whose template is compiled once per (host, text) in ``cache``
+        t = cache.get((host, src))
+        if t is None:
+            spec = []
+            t = cache[host, src] = (self._template(parse(src), host, spec), spec)
+        f = _Formula(host, r, c, src, dr, dc, t[0])
+        f.refs = _bind(t[1], dr, dc)
+        return f
+
+    def _swap(self, old, new):
+        # replace formulas; journaled as a drop then an add, so rewind() undoes both
+        for f in old:
+            self._unregister(f)
+            cells = self.cells.get(f.sheet)
+            if cells and cells.get((f.r, f.c)) is f: del cells[f.r, f.c]
+        for f in new:
+            self.cells.setdefault(f.sheet, {})[f.r, f.c] = f
+            self._register(f)
+        self._log("drop", old)
+        self._log("add", new)
+
+    @contextmanager
+    def _quiet(self):
+        # a structural edit: its writes move cells the engine moves itself, so are not queued
+        self._busy = threading.get_ident()
+        try: yield
+        finally: self._busy = None
+
+    # ── graph ──
+    def _hook(self, sheet):
+        if sheet in self._hooked: return
+        self._hooked.add(sheet)
+        sheet.watch.append(lambda r1, c1, r2, c2: self._changed(sheet, r1, c1, r2, c2))
+
+    def _changed(self, sheet, r1, c1, r2, c2):
+        if self._busy != threading.get_ident(): self.pending.append((sheet, r1, c1, r2, c2))
+
+    def _register(self, f):
+        for sh, r1, c1, r2, c2 in f.refs:
+            if r1 == r2 and c1 == c2:
+                self.point.setdefault(sh, {}).setdefault((r1, c1), set()).add(f)
+            else:
+                cols = self.span.setdefault(sh, {})
+                for c in range(c1, c2 + 1): cols.setdefault(c, []).append((r1, r2, f))
+
+    def _unregister(self, f):
+        # range entries are swept lazily by _dependents
+        f.dead = True
+        for sh, r1, c1, r2, c2 in f.refs:
+            if r1 == r2 and c1 == c2: self.point.get(sh, {}).get((r1, c1), set()).discard(f)
+
+    def _drop(self, sheet, r1, c1, r2, c2):
+        cells = self.cells.get(sheet)
+        if not cells: return
+        if (r2 - r1 + 1) * (c2 - c1 + 1) <= len(cells):
+            keys = [(r, c) for r in range(r1, r2 + 1) for c in range(c1, c2 + 1) if (r, c) in cells]
+        else:
+            keys = [k for k in cells if r1 <= k[0] <= r2 and c1 <= k[1] <= c2]
+        fs = [cells.pop(k) for k in keys]
+        for f in fs: self._unregister(f)
+        self._log("drop", fs)
+
+    def _log(self, op, fs):
+        if self.journal is not None and fs: self.journal = (self.journal, op, fs, self.journal[3] + 1)
+
+    def _undo(self, entry):
+        self._apply(entry[1] == "drop", entry[2])
+
+    def _apply(self, add, fs):
+        # put journaled formulas back (add) or take them out again
+        for f in fs:
+            if add:
+                f.dead = False
+                self.cells.setdefault(f.sheet, {})[f.r, f.c] = f
+                self._register(f)
+            else:
+                self._unregister(f)
+                cells = self.cells.get(f.sheet)
+                if cells and cells.get((f.r, f.c)) is f: del cells[f.r, f.c]
+
+    def _dependents(self, sheet, r1, c1, r2, c2):
+        out = set()
+        pt = self.point.get(sheet)
+        if pt:
+            if (r2 - r1 + 1) * (c2 - c1 + 1) <= len(pt):
+                for r in range(r1, r2 + 1):
+                    for c in range(c1, c2 + 1):
+                        fs = pt.get((r, c))
+                        if fs: out |= fs
+            else:
+                for (r, c), fs in pt.items():
+                    if r1 <= r <= r2 and c1 <= c <= c2: out |= fs
+        sp = self.span.get(sheet)
+        if sp:
+            for c in (range(c1, c2 + 1) if c2 - c1 < len(sp) else [c for c in sp if c1 <= c <= c2]):
+                lst = sp.get(c)
+                if not lst: continue
+                dead = False
+                for a, b, f in lst:
+                    if f.dead: dead = True
+                    elif a <= r2 and r1 <= b: out.add(f)
+                if dead: lst[:] = [e for e in lst if not e[2].dead]
+        return out
+
+    def _recalc(self, seeds):
+        # iterative DFS over "is read by" edges; reversed post-order is a topological order
+        state, order, cyc = {}, [], set()
+        for s0 in seeds:
+            if s0.dead or s0 in state: continue
+            state[s0] = 1
+            stack = [(s0, iter(self._dependents(s0.sheet, s0.r, s0.c, s0.r, s0.c)))]
+            while stack:
+                f, it = stack[-1]
+                for g in it:
+                    st = state.get(g)
+                    if st is None:
+                        state[g] = 1
+                        stack.append((g, iter(self._dependents(g.sheet, g.r, g.c, g.r, g.c))))
+                        break
+                    if st == 1:  # back edge: the stack from g up is a cycle
+                        i = len(stack) - 1
+                        while stack[i][0] is not g: i -= 1
+                        cyc.update(x for x, _ in stack[i:])
+                else:
+                    stack.pop()
+                    state[f] = 2
+                    order.append(f)
+        self._memo = {}
+        self._busy = threading.get_ident()
+        try:
+            for f in reversed(order):
+                if f.dead: continue
+                if f in cyc: v = CIRC
+                else:
+                    try: v = f.fn(f.dr, f.dc)
+                    except Exception: v = VALUE
+                    v = _scalar(v)
+                    v = 0 if v is None else _fix(v)
+                f.sheet.set(f.r, f.c, v)
+        finally:
+            self._busy = None
+
+    # ── compile ──
+    def _sheet(self, name, host):
+        if name is None: return host
+        sh = self.sheets.get(name)
+        if sh is None:
+            sh = next((v for k, v in self.sheets.items() if k.casefold() == name.casefold()), None)
+        return sh
+
+    def _template(self, node, host, refs):
+        """Closure ``fn(dr, dc)`` evaluating ``node`` for a formula filled ``dr``
+        rows / ``dc`` columns from where it was written; one template serves a
+        whole fill. Appends ``(sheet, corner, corner)`` per reference to ``refs``."""
+        k = node[0]
+        if k in ("num", "str", "bool", "err"):
+            v = node[1]
+            return lambda dr, dc: v
+        if k in ("ref", "rng"):
+            sh = self._sheet(node[1], host)
+            if sh is None: return lambda dr, dc: REF
+            self._hook(sh)
+            refs.append((sh, node[2], node[-1]))  # a single ref is its own second corner
+            (r1, c1, ra1, ca1), (r2, c2, ra2, ca2) = node[2], node[-1]
+            if k == "ref":
+                cell = sh.cell
+                if ra1 and ca1: return lambda dr, dc: cell(r1, c1)
+                def ref(dr, dc):
+                    r, c = r1 if ra1 else r1 + dr, c1 if ca1 else c1 + dc
+                    return cell(r, c) if r >= 1 and c >= 1 else REF
+                return ref
+            if ra1 and ca1 and ra2 and ca2:
+                rng = _Rng(sh, min(r1, r2), min(c1, c2), max(r1, r2), max(c1, c2))
+                return lambda dr, dc: rng
+            def span(dr, dc):
+                a, b = r1 if ra1 else r1 + dr, r2 if ra2 else r2 + dr
+                x, y = c1 if ca1 else c1 + dc, c2 if ca2 else c2 + dc
+                if min(a, b) < 1 or min(x, y) < 1: return REF
+                return _Rng(sh, min(a, b), min(x, y), max(a, b), max(x, y))
+            return span
+        if k == "neg":
+            a = self._template(node[1], host, refs)
+            return lambda dr, dc: _arith(operator.sub, 0, a(dr, dc))
+        if k == "pct":
+            a = self._template(node[1], host, refs)
+            return lambda dr, dc: _arith(operator.truediv, a(dr, dc), 100)
+        if k == "op":
+            op, a, b = node[1], self._template(node[2], host, refs), self._template(node[3], host, refs)
+            if op in _OPS:
+                fn = _OPS[op]
+                return lambda dr, dc: _arith(fn, a(dr, dc), b(dr, dc))
+            if op == "&":
+                def cat(dr, dc):
+                    x, y = _text(a(dr, dc)), _text(b(dr, dc))
+                    return x if type(x) is Err else y if type(y) is Err else x + y
+                return cat
+            cmp = _CMP[op]
+            return lambda dr, dc: _compare(cmp, a(dr, dc), b(dr, dc))
+        name, args = node[1], node[2]
+        if name not in _AGG and name not in _ARITY: return lambda dr, dc: NAME
+        if name in _AGG:
+            # a single-cell reference is a 1x1 range here: text in it is skipped, not an error
+            fs = [self._template(("rng", a[1], a[2], a[2]) if a[0] == "ref" else a, host, refs) for a in args]
+            agg = _AGG[name]
+            return lambda dr, dc: agg([x(dr, dc) for x in fs])
+        fs = [self._template(a, host, refs) for a in args]
+        if name == "IF":
+            c, t, e = fs[0], fs[1], fs[2] if len(fs) > 2 else (lambda dr, dc: False)
+            def cond(dr, dc):
+                b = _bool(c(dr, dc))
+                return b if type(b) is Err else t(dr, dc) if b else e(dr, dc)
+            return cond
+        return lambda dr, dc: self._vlookup(*[x(dr, dc) for x in fs])
+
+    def _vlookup(self, x, table, col, approx=True):
+        x = _scalar(x)
+        if type(x) is Err: return x
+        if type(table) is not _Rng: return VALUE
+        col = _num(_scalar(col))
+        if type(col) is Err: return col
+        col = int(col)
+        if col < 1: return VALUE
+        if col > table.c2 - table.c1 + 1: return REF
+        approx = _bool(approx)
+        if type(approx) is Err: return approx
+        key = _lkey(x)
+        if key is None: return NA
+        r1, c1, r2, _ = table.bounds()
+        if approx:
+            hit = None
+            for i, v in enumerate(table.sheet.read_col(c1, r1, r2)):
+                kv = _lkey(v)
+                if kv is None or kv[0] != key[0]: continue
+                if kv > key: break
+                hit = i
+        else:
+            mk = (table.sheet, c1, r1, r2)
+            idx = self._memo.get(mk)
+            if idx is None:
+                idx = self._memo[mk] = {}
+                for i, v in enumerate(table.sheet.read_col(c1, r1, r2)):
+                    kv = _lkey(v)
+                    if kv is not None: idx.setdefault(kv, i)
+            hit = idx.get(key)
+        if hit is None: return NA
+        return table.sheet.cell(table.r1 + hit, table.c1 + col - 1)
@@ -0,0 +1,211 @@
+"""
+Pivot engine for the VWB virtual workbook (test_api.py)
+Single-pass hash group-by over a source range, refreshed incrementally
+"""
+from vwb_store import _sort_key
+
+FUNCS = {"sum": "Sum", "count": "Count", "average": "Average", "avg": "Average",
+         "min": "Min", "max": "Max"}
+_NUM = (int, float)
+_FULL = 0.25  # rebuild from scratch when more than this share of rows changed
+
+
+def _blank(vals):
+    # "" and None are the same empty key: one "(blank)" group, sorted last
+    return [None if v == "" else v for v in vals] if "" in vals else vals
+
+
+class Pivot:
+    """Aggregates of one pivot table over ``sheet`` rows r1..r2, cols c1..c2.
+
+    The first source row holds the field names. Per group the engine keeps
+    ``[sum, numeric count, non-empty count, min, max, rows]`` for every value field
+    together with each source row's key and values, so a changed row is
+    applied as a retract/add delta instead of a full rescan. Only min/max
+    losing their current extreme forces a rebuild.
+    """
+
+    def __init__(self, sheet, rng, row_fields, value_fields, column_fields=(), func="sum"):
+        self.sheet = sheet
+        self.r1, self.c1, self.r2, self.c2 = rng
+        self.func = FUNCS.get((func or "sum").lower())
+        if not self.func: raise ValueError(f"Unsupported value_function '{func}'")
+        self.fields = (list(row_fields), list(column_fields or []), list(value_fields))
+        if not self.fields[0] and not self.fields[1]: raise ValueError("row_fields or column_fields required")
+        if not self.fields[2]: raise ValueError("value_fields required")
+        self.dirty = []     # changed (first, last) source rows since the last refresh
+        self.stale = True   # full rebuild needed
+        sheet.watch.append(self._on_change)
+
+    def __repr__(self):
+        return f"<Pivot {self.func} of {self.fields[2]} by {self.fields[0]}/{self.fields[1]}>"
+
+    def clone(self, sheet=None, rng=None):
+        """New engine for the same pivot (over ``sheet``, e.g. a fork's, or source
+        range ``rng``); builds on first refresh. Engines held by snapshots must not change."""
+        return Pivot(sheet or self.sheet, rng or (self.r1, self.c1, self.r2, self.c2), self.fields[0],
+                     self.fields[2], self.fields[1], self.func.lower())
+
+    def close(self):
+        if self._on_change in self.sheet.watch: self.sheet.watch.remove(self._on_change)
+
+    def _on_change(self, r1, c1, r2, c2):
+        if r2 < self.r1 or r1 > self.r2 or c2 < self.c1 or c1 > self.c2: return
+        if r1 <= self.r1: self.stale = True  # header row touched
+        elif not self.stale: self.dirty.append((r1, min(r2, self.r2)))
+
+    # ── build ──
+    def _cols(self):
+        hdr = ["" if v is None else str(v).strip().lower()
+               for v in self.sheet.read(self.r1, self.c1, self.r1, self.c2)[0]]
+        out = []
+        for group in self.fields:
+            idx = []
+            for f in group:
+                k = str(f).strip().lower()
+                if k not in hdr: raise ValueError(f"Field '{f}' not found in source headers")
+                idx.append(self.c1 + hdr.index(k))
+            out.append(idx)
+        return out
+
+    def _keys(self, r1, r2):
+        rc, cc, _ = self.cols
+        rk = [_blank(self.sheet.read_col(c, r1, r2)) for c in rc]
+        ck = [_blank(self.sheet.read_col(c, r1, r2)) for c in cc]
+        rk = rk[0] if len(rk) == 1 else list(zip(*rk)) if rk else [()] * (r2 - r1 + 1)
+        if not cc: return rk
+        ck = ck[0] if len(ck) == 1 else list(zip(*ck))
+        return list(zip(rk, ck))
+
+    def _build(self):
+        self.cols = self._cols()
+        d1 = self.r1 + 1
+        self.keys = self._keys(d1, self.r2) if self.r2 >= d1 else []
+        self.vals = [self.sheet.read_col(c, d1, self.r2) for c in self.cols[2]]
+        mm = self.func in ("Min", "Max")
+        self.acc = []
+        for vals in self.vals:
+            acc = {}
+            for k, v in zip(self.keys, vals):
+                a = acc.get(k)
+                if a is None: a = acc[k] = [0, 0, 0, None, None, 0]
+                a[5] += 1
+                if v is None: continue
+                a[2] += 1
+                if type(v) in _NUM:
+                    a[0] += v; a[1] += 1
+                    if mm:
+                        if a[3] is None or v < a[3]: a[3] = v
+                        if a[4] is None or v > a[4]: a[4] = v
+            self.acc.append(acc)
+        self.stale = False
+        self.dirty = []
+
+    def _apply(self, rows):
+        # retract each changed row's old contribution and add its new one
+        d1 = self.r1 + 1
+        mm = self.func in ("Min", "Max")
+        for a, b in rows:
+            new_keys = self._keys(a, b)
+            new_vals = [self.sheet.read_col(c, a, b) for c in self.cols[2]]
+            for j in range(b - a + 1):
+                i = a - d1 + j
+                ok, nk = self.keys[i], new_keys[j]
+                for f, acc in enumerate(self.acc):
+                    ov, nv = self.vals[f][i], new_vals[f][j]
+                    if ok == nk and ov == nv and type(ov) is type(nv): continue
+                    g = acc[ok]
+                    g[5] -= 1
+                    if not g[5]: del acc[ok]
+                    if ov is not None:
+                        g[2] -= 1
+                        if type(ov) in _NUM:
+                            g[0] -= ov; g[1] -= 1
+                            if mm and (ov == g[3] or ov == g[4]): return False
+                    g = acc.get(nk)
+                    if g is None: g = acc[nk] = [0, 0, 0, None, None, 0]
+                    g[5] += 1
+                    if nv is not None:
+                        g[2] += 1
+                        if type(nv) in _NUM:
+                            g[0] += nv; g[1] += 1
+                            if mm:
+                                if g[3] is None or nv < g[3]: g[3] = nv
+                                if g[4] is None or nv > g[4]: g[4] = nv
+                    self.vals[f][i] = nv
+                self.keys[i] = nk
+        return True
+
+    def refresh(self):
+        """Bring the aggregates up to date; returns True if anything changed."""
+        if not self.stale and not self.dirty: return False
+        if not self.stale:
+            n = max(self.r2 - self.r1, 1)
+            changed = sum(b - a + 1 for a, b in self.dirty)
+            if changed > n * _FULL or not self._apply(sorted(set(self.dirty))): self.stale = True
+            self.dirty = []
+        if self.stale: self._build()
+        return True
+
+    # ── output ──
+    def _agg(self, parts):
+        if not parts: return None  # no source rows at this intersection: blank, as in Excel
+        s = n = cnt = 0
+        lo = hi = None
+        for g in parts:
+            s += g[0]; n += g[1]; cnt += g[2]
+            if g[3] is not None and (lo is None or g[3] < lo): lo = g[3]
+            if g[4] is not None and (hi is None or g[4] > hi): hi = g[4]
+        f = self.func
+        if f == "Sum": return s
+        if f == "Count": return cnt
+        if f == "Average": return s / n if n else None
+        return lo if f == "Min" else hi
+
+    def table(self):
+        """Pivot output as a row-major 2D list, including grand totals."""
+        self.refresh()
+        rf, cf, vf = self.fields
+        labels = [f"{self.func} of {v}" for v in vf]
+        has_c = bool(cf)
+        rows = {}
+        ckeys = set()
+        for f, acc in enumerate(self.acc):
+            for k, g in acc.items():
+                rk, ck = k if has_c else (k, None)
+                ckeys.add(ck)
+                rows.setdefault(rk, {}).setdefault((ck, f), []).append(g)
+        rkeys = sorted(rows, key=self._order)
+        ckeys = sorted(ckeys, key=self._order) if has_c else [None]
+        blank = lambda k: "(blank)" if k is None else k
+        as_row = lambda k: list(k) if isinstance(k, tuple) else [k]
+        nrf = max(len(rf), 1)
+        head = list(rf) or [""]
+        for ck in ckeys:
+            cl = " / ".join(map(str, map(blank, as_row(ck)))) if has_c else None
+            head += [(f"{cl} - {l}" if len(vf) > 1 else cl) if has_c else l for l in labels]
+        if has_c: head += [f"Grand Total - {l}" if len(vf) > 1 else "Grand Total" for l in labels]
+        out = [head]
+        for rk in rkeys:
+            cells = rows[rk]
+            line = [blank(x) for x in as_row(rk)] if rf else ["Total"]
+            line += [""] * (nrf - len(line))
+            for ck in ckeys:
+                line += [self._agg(cells.get((ck, f), ())) for f in range(len(vf))]
+            if has_c:
+                line += [self._agg([g for (ck, ff), gs in cells.items() if ff == f for g in gs])
+                         for f in range(len(vf))]
+            out.append(line)
+        if rf:
+            total = ["Grand Total"] + [""] * (nrf - 1)
+            for ck in ckeys:
+                total += [self._agg([g for k, g in acc.items() if not has_c or k[1] == ck])
+                          for acc in self.acc]
+            if has_c: total += [self._agg(acc.values()) for acc in self.acc]
+            out.append(total)
+        return out
+
+    @staticmethod
+    def _order(k):
+        key = _sort_key(False)
+        return tuple(map(key, k)) if isinstance(k, tuple) else key(k)
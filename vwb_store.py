@@ -0,0 +1,350 @@
+"""
+Sheet storage for the VWB virtual workbook (test_api.py)
+Column-oriented, block-backed cells with an incrementally kept used-range box
+"""
+import threading
+from operator import itemgetter
+
+BLOCK = 4096  # rows per column block
+
+
+def _pick(vals, idx):
+    # vals[i] for i in idx, done by itemgetter in C rather than a Python loop
+    if not idx: return []
+    if len(idx) == 1: return [vals[idx[0]]]
+    return list(itemgetter(*idx)(vals))
+
+
+def _sort_key(desc):
+    # Excel order: numbers < text < booleans, blanks last in both directions
+    blank = (-1, 0) if desc else (3, 0)
+    def key(v):
+        if v is None or v == "": return blank
+        t = type(v)
+        if t is bool: return (2, v)
+        if t is int or t is float: return (0, v)
+        return (1, str(v).lower())
+    return key
+
+
+def sort_order(keys, n):
+    """Stable multi-key sort permutation of ``range(n)``.
+
+    ``keys`` is a list of ``(column_values, descending)`` pairs, most
+    significant first. Each pass is a C-level ``list.sort`` over precomputed
+    keys; sorting by the least significant key first keeps the result stable.
+    """
+    idx = list(range(n))
+    for vals, desc in reversed(keys):
+        ts = set(map(type, vals))
+        if ts <= {int, float}: kv = vals  # homogeneous columns skip the per-cell key function
+        elif ts == {str} and "" not in vals: kv = list(map(str.lower, vals))
+        else: kv = list(map(_sort_key(desc), vals))
+        idx.sort(key=kv.__getitem__, reverse=desc)
+    return idx
+
+
+def unique_rows(cols, n):
+    """Indices of the first occurrence of each distinct row over ``cols``."""
+    seen = set()
+    add = seen.add
+    keep = []
+    for i, k in enumerate(zip(*cols) if cols else [()] * n):
+        if k not in seen:
+            add(k); keep.append(i)
+    return keep
+
+
+def shift_row(x, at, n):
+    """Where row ``x`` ends up after ``n`` rows are inserted (n > 0) or deleted
+    (n < 0) at row ``at``; a deleted row maps to the first row after the gap."""
+    if n > 0: return x + n if x >= at else x
+    return x - max(0, min(x - 1, at - n - 1) - at + 1)
+
+
+def shift_span(r1, r2, at, n):
+    """Rows ``r1..r2`` after the same change, as Excel adjusts a range:
+    rows inserted or deleted inside grow or shrink it, rows above move it."""
+    if at > r2: return r1, r2
+    e = r2 + n if n > 0 else shift_row(r2 + 1, at, n) - 1
+    r1 = shift_row(r1, at, n)
+    return r1, max(e, r1)
+
+
+def _changed_blocks(a, b):
+    # (col, block) pairs whose block object differs between two block maps
+    if a is b: return []
+    out = []
+    for c in a.keys() | b.keys():
+        ca, cb = a.get(c) or {}, b.get(c) or {}
+        if ca is cb: continue
+        out += [(c, k) for k in ca.keys() | cb.keys() if ca.get(k) is not cb.get(k)]
+    return out
+
+
+class Sheet:
+    """Cells of one sheet, stored per column in fixed-size row blocks.
+
+    ``cols[c][b]`` is a list of BLOCK values covering rows ``b*BLOCK+1 ..
+    (b+1)*BLOCK``; ``None`` marks an empty cell. Rows and columns are 1-based,
+    as in Excel. The used-range box is grown on every write and only rescanned
+    after cells have been cleared, so ``bbox()`` is O(1) for append-only use.
+
+    The class also behaves like the old ``{(row, col): value}`` dict, so
+    ``sheet[(r, c)] = v`` and ``sheet.get((r, c), "")`` keep working.
+
+    ``watch`` holds callbacks ``fn(r1, c1, r2, c2)`` called after every write
+    with the rectangle that was touched (used by pivots to refresh).
+    Writes hold a per-sheet lock, so tool calls on disjoint ranges may run
+    from several threads; reads take no lock.
+
+    ``snapshot()`` and ``fork()`` are O(1): they share the block map, and from
+    then on a write copies only the column map and block it touches
+    (``_own`` holds the ids of the ones this sheet may write in place;
+    None means it owns everything).
+    """
+    __slots__ = ("cols", "watch", "_n", "_box", "_dirty", "_lock", "_own")
+
+    def __init__(self):
+        self.cols = {}
+        self.watch = []
+        self._n = 0
+        self._box = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._own = None
+
+    # ── dict compatibility ──
+    def __len__(self): return self._n
+    def __bool__(self): return self._n > 0
+    def __contains__(self, k): return self.cell(*k) is not None
+    def __getitem__(self, k):
+        v = self.cell(*k)
+        if v is None: raise KeyError(k)
+        return v
+    def __setitem__(self, k, v): self.set(k[0], k[1], v)
+    def __delitem__(self, k): self.set(k[0], k[1], None)
+    def get(self, k, default=None):
+        v = self.cell(*k)
+        return default if v is None else v
+    def __iter__(self): return (k for k, _ in self.items())
+    def keys(self): return iter(self)
+    def items(self):
+        for c in sorted(self.cols):
+            for b in sorted(self.cols[c]):
+                base = b * BLOCK + 1
+                for i, v in enumerate(self.cols[c][b]):
+                    if v is not None: yield (base + i, c), v
+
+    # ── cell access ──
+    def cell(self, r, c):
+        blk = self.cols.get(c, {}).get((r - 1) // BLOCK)
+        return None if blk is None else blk[(r - 1) % BLOCK]
+
+    def set(self, r, c, v):
+        if r < 1 or c < 1: raise ValueError(f"Invalid cell R{r}C{c}")
+        b, o = divmod(r - 1, BLOCK)
+        with self._lock:
+            col = self.cols.get(c)
+            blk = None if col is None else col.get(b)
+            if blk is None:
+                if v is None: return
+                blk = self._wcol(c)[b] = self._new()
+            elif self._own is not None and id(blk) not in self._own:
+                blk = self._wblk(self._wcol(c), b)
+            old = blk[o]
+            blk[o] = v
+            if old is None and v is not None:
+                self._n += 1
+                self._grow(r, c, r, c)
+            elif old is not None and v is None:
+                self._n -= 1
+                self._dirty = True
+        for fn in self.watch: fn(r, c, r, c)
+
+    # ── bulk access ──
+    def read_col(self, c, r1, r2):
+        """Values of column ``c`` for rows r1..r2 as a flat list."""
+        col = self.cols.get(c)
+        n = r2 - r1 + 1
+        if not col or n <= 0: return [None] * max(n, 0)
+        out = []
+        r = r1
+        while r <= r2:
+            b, o = divmod(r - 1, BLOCK)
+            k = min(BLOCK - o, r2 - r + 1)
+            blk = col.get(b)
+            out.extend(blk[o:o + k] if blk is not None else [None] * k)
+            r += k
+        return out
+
+    def write_col(self, c, r1, vals):
+        """Overwrite column ``c`` from row ``r1`` with ``vals`` (None clears)."""
+        n = len(vals)
+        if not n: return
+        if r1 < 1 or c < 1: raise ValueError(f"Invalid cell R{r1}C{c}")
+        with self._lock:
+            col = self._wcol(c)
+            added = removed = 0
+            i = 0
+            while i < n:
+                b, o = divmod(r1 + i - 1, BLOCK)
+                k = min(BLOCK - o, n - i)
+                part = vals[i:i + k]
+                new = k - part.count(None)
+                blk = self._wblk(col, b)
+                if blk is None:
+                    if new:
+                        blk = col[b] = self._new()
+                        blk[o:o + k] = part
+                        added += new
+                else:
+                    removed += k - blk[o:o + k].count(None)
+                    blk[o:o + k] = part
+                    added += new
+                i += k
+            if not col: del self.cols[c]
+            self._n += added - removed
+            if removed: self._dirty = True
+            if added:
+                lo = 0
+                while vals[lo] is None: lo += 1
+                hi = n - 1
+                while vals[hi] is None: hi -= 1
+                self._grow(r1 + lo, c, r1 + hi, c)
+        for fn in self.watch: fn(r1, c, r1 + n - 1, c)
+
+    def read(self, r1, c1, r2, c2):
+        """Row-major 2D list for the rectangle, built from column slices."""
+        if r2 < r1 or c2 < c1: return []
+        cols = [self.read_col(c, r1, r2) for c in range(c1, c2 + 1)]
+        return [list(row) for row in zip(*cols)]
+
+    def write(self, r, c, rows):
+        """Write a row-major 2D list at (r, c); returns cells written."""
+        if not rows: return 0
+        w = max(len(row) for row in rows)
+        if all(len(row) == w for row in rows):
+            for ci, vals in enumerate(zip(*rows)):
+                self.write_col(c + ci, r, list(vals))
+            return w * len(rows)
+        n = 0
+        for ri, row in enumerate(rows):  # ragged rows: leave the gaps untouched
+            for ci, v in enumerate(row):
+                self.set(r + ri, c + ci, v)
+            n += len(row)
+        return n
+
+    def clear(self, r1, c1, r2, c2):
+        for c in [c for c in self.cols if c1 <= c <= c2]:
+            self.write_col(c, r1, [None] * (r2 - r1 + 1))
+
+    def take_rows(self, r1, c1, r2, c2, idx):
+        """Rewrite the rectangle with its rows ``idx`` (0-based), blank-padded below."""
+        pad = [None] * (r2 - r1 + 1 - len(idx))
+        for c in [c for c in self.cols if c1 <= c <= c2]:
+            self.write_col(c, r1, _pick(self.read_col(c, r1, r2), idx) + pad)
+
+    def delete_rows(self, r, n):
+        """Delete ``n`` whole rows at ``r``, shifting everything below up."""
+        bx = self.bbox()
+        if bx is None or r > bx[2]: return
+        for c in list(self.cols):
+            self.write_col(c, r, self.read_col(c, r + n, bx[2]) + [None] * min(n, bx[2] - r + 1))
+
+    def insert_rows(self, r, n):
+        """Insert ``n`` blank rows at ``r``, shifting everything below down."""
+        bx = self.bbox()
+        if bx is None or r > bx[2]: return
+        for c in list(self.cols):
+            self.write_col(c, r, [None] * n + self.read_col(c, r, bx[2]))
+
+    # ── copy-on-write ──
+    # callers hold the lock
+    def _new(self):
+        blk = [None] * BLOCK
+        if self._own is not None: self._own.add(id(blk))
+        return blk
+
+    def _wtop(self):
+        own = self._own
+        if own is not None and id(self.cols) not in own:
+            self.cols = dict(self.cols)
+            own.add(id(self.cols))
+        return self.cols
+
+    def _wcol(self, c):
+        """Column map of ``c`` that may be written in place, created if missing."""
+        own = self._own
+        if own is None: return self.cols.setdefault(c, {})
+        cols = self._wtop()
+        col = cols.get(c)
+        if col is None or id(col) not in own:
+            col = cols[c] = dict(col or {})
+            own.add(id(col))
+        return col
+
+    def _wblk(self, col, b):
+        # block b of an owned column map, copied first if a snapshot shares it
+        blk = col.get(b)
+        if blk is not None and self._own is not None and id(blk) not in self._own:
+            blk = col[b] = blk[:]
+            self._own.add(id(blk))
+        return blk
+
+    def snapshot(self):
+        """Frozen state for ``restore()``; O(1), later writes copy what they touch."""
+        with self._lock:
+            if self._dirty: self._rescan()
+            self._own = set()
+            return (self.cols, self._n, self._box)
+
+    def restore(self, snap):
+        """Return to a snapshot. Watchers hear only about the blocks that differ."""
+        with self._lock:
+            changed = _changed_blocks(self.cols, snap[0])
+            self.cols, self._n, self._box = snap
+            self._dirty = False
+            self._own = set()  # the snapshot still holds these blocks
+        for c, b in changed:
+            for fn in self.watch: fn(b * BLOCK + 1, c, (b + 1) * BLOCK, c)
+
+    def fork(self):
+        """Independent sheet sharing every block with this one until either side writes."""
+        sh = Sheet()
+        sh.cols, sh._n, sh._box = self.snapshot()
+        sh._own = set()
+        return sh
+
+    # ── used range ──
+    def _grow(self, r1, c1, r2, c2):
+        bx = self._box
+        if bx is None: self._box = (r1, c1, r2, c2)
+        elif r1 < bx[0] or c1 < bx[1] or r2 > bx[2] or c2 > bx[3]:
+            self._box = (min(r1, bx[0]), min(c1, bx[1]), max(r2, bx[2]), max(c2, bx[3]))
+
+    def bbox(self):
+        """(r1, c1, r2, c2) of the used range, or None when the sheet is empty."""
+        if self._dirty:
+            with self._lock: self._rescan()
+        return self._box
+
+    def _rescan(self):
+        # Only needed after clears; also drops blocks and columns that became empty.
+        box = None
+        for c in list(self.cols):
+            col = self.cols[c]
+            empty = [b for b, blk in col.items() if blk.count(None) == BLOCK]
+            if empty:
+                col = self._wcol(c)
+                for b in empty: del col[b]
+            if not col:
+                del self._wtop()[c]; continue
+            bs = sorted(col)
+            first, last = col[bs[0]], col[bs[-1]]
+            lo = bs[0] * BLOCK + next(i for i, v in enumerate(first) if v is not None) + 1
+            hi = bs[-1] * BLOCK + BLOCK - next(i for i, v in enumerate(reversed(last)) if v is not None)
+            box = (lo, c, hi, c) if box is None else \
+                (min(lo, box[0]), min(c, box[1]), max(hi, box[2]), max(c, box[3]))
+        self._box = box
+        self._dirty = False
@@ -0,0 +1,206 @@
+"""
+Record/replay cache and local stand-in server for z.ai /chat/completions
+Cassettes are keyed by a hash of the normalised request (model, messages, tools)
+"""
+import argparse, hashlib, json, os, random, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from zai_stream import events
+
+
+def request_key(body):
+    """sha256 of the parts of a completion request that decide the answer."""
+    norm = {"model": body.get("model"), "messages": body.get("messages", []),
+            "tools": body.get("tools") or []}
+    raw = json.dumps(norm, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """Append-only store of responses in ``<dir>/cassette.jsonl``.
+
+    Each line is ``{"key": ..., "response": ...}``. Opening the cassette scans
+    the file once and keeps only ``key -> byte offset`` in memory; a hit
+    seeks to its line, so large cassettes cost one int per entry. A later
+    entry with the same key wins.
+    """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.file = os.path.join(path, "cassette.jsonl")
+        self.index = {}
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.exists(self.file):
+            with open(self.file, "rb") as f:
+                pos = 0
+                for line in f:
+                    if line.strip():
+                        key = json.loads(line)["key"]
+                        self.index[key] = pos
+                    pos += len(line)
+
+    def __len__(self): return len(self.index)
+    def __contains__(self, body): return request_key(body) in self.index
+
+    def get(self, body):
+        """Recorded response for ``body`` or None."""
+        pos = self.index.get(request_key(body))
+        if pos is None:
+            self.misses += 1
+            return None
+        with self._lock, open(self.file, "rb") as f:
+            f.seek(pos)
+            line = f.readline()
+        self.hits += 1
+        return json.loads(line)["response"]
+
+    def put(self, body, response):
+        key = request_key(body)
+        line = (json.dumps({"key": key, "response": response}, ensure_ascii=False,
+                           separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock, open(self.file, "ab") as f:
+            pos = f.seek(0, os.SEEK_END)
+            f.write(line)
+            self.index[key] = pos
+
+
+# ── scripted responses ──
+def tool_call(name, /, **args):
+    """Assistant message calling one tool; pass several to ``tool_calls()`` for a batch."""
+    return tool_calls((name, args))
+
+
+def tool_calls(*calls):
+    return {"role": "assistant", "content": "", "tool_calls": [
+        {"id": f"call_{i}_{n}", "type": "function",
+         "function": {"name": n, "arguments": json.dumps(a, ensure_ascii=False)}}
+        for i, (n, a) in enumerate(calls)]}
+
+
+def reply(text):
+    return {"role": "assistant", "content": text}
+
+
+def completion(msg, model="stub", prompt_chars=0):
+    """Wrap an assistant message in the /chat/completions response shape."""
+    done = "tool_calls" if msg.get("tool_calls") else "stop"
+    out_chars = len(json.dumps(msg, ensure_ascii=False))
+    return {"id": f"stub-{time.time_ns()}", "object": "chat.completion", "created": int(time.time()),
+            "model": model, "choices": [{"index": 0, "message": msg, "finish_reason": done}],
+            "usage": {"prompt_tokens": prompt_chars // 4, "completion_tokens": out_chars // 4,
+                      "total_tokens": (prompt_chars + out_chars) // 4}}
+
+
+def scripted(script):
+    """Responder for ``{prompt_substring: [message, ...]}``.
+
+    The conversation is matched by a substring of its first user message
+    (``"*"`` matches anything) and the n-th message is served when the
+    request already holds n assistant messages, so no server state is kept.
+    """
+    def respond(body):
+        msgs = body.get("messages", [])
+        user = next((m.get("content") or "" for m in msgs if m.get("role") == "user"), "")
+        steps = next((v for k, v in script.items() if k != "*" and k in user), script.get("*"))
+        if steps is None: return None
+        n = sum(1 for m in msgs if m.get("role") == "assistant")
+        return steps[min(n, len(steps) - 1)]
+    return respond
+
+
+class StubServer:
+    """Local HTTP stand-in for ``{API_BASE}/chat/completions``.
+
+    Answers from ``responder(body) -> assistant message`` (see ``scripted``)
+    and then from ``cassette``; anything else gets a 404 error body. Every
+    answer waits ``latency`` seconds, or a uniform draw from a ``(lo, hi)``
+    pair, to mimic network time. Requests with ``"stream": true`` get the
+    answer as chunked SSE, ``chunk_delay`` seconds apart.
+    """
+
+    def __init__(self, cassette=None, responder=None, latency=0.0, chunk_delay=0.0, host="127.0.0.1", port=0):
+        self.cassette, self.responder, self.latency = cassette, responder, latency
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real endpoint
+            disable_nagle_algorithm = True  # headers and body go out as separate writes
+            def log_message(self, *a): pass
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                code, resp, sse = stub._answer(self.path, raw)
+                if sse and code == 200: return self._sse(resp)
+                out = json.dumps(resp, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def _sse(self, resp):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for ev in events(resp):
+                    data = f"data: {ev}\n\n".encode("utf-8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    if stub.chunk_delay: time.sleep(stub.chunk_delay)
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        h, p = self.httpd.server_address[:2]
+        return f"http://{h}:{p}"
+
+    def _delay(self):
+        lat = self.latency
+        d = random.uniform(*lat) if isinstance(lat, (tuple, list)) else lat
+        if d > 0: time.sleep(d)
+
+    def _answer(self, path, raw):
+        self.requests += 1
+        if not path.rstrip("/").endswith("/chat/completions"):
+            return 404, {"error": {"code": "404", "message": f"Unknown path {path}"}}, False
+        try: body = json.loads(raw)
+        except ValueError: return 400, {"error": {"code": "400", "message": "Invalid JSON body"}}, False
+        self._delay()
+        sse = bool(body.get("stream"))
+        msg = self.responder(body) if self.responder else None
+        if msg is not None:
+            return 200, completion(msg, body.get("model", "stub"), len(raw)), sse
+        resp = self.cassette.get(body) if self.cassette else None
+        if resp is not None: return 200, resp, sse
+        return 404, {"error": {"code": "cassette_miss", "message": "No recorded response for this request"}}, False
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self): return self.start()
+    def __exit__(self, *exc): self.stop()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Serve recorded z.ai responses locally")
+    ap.add_argument("cassette", help="cassette directory")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds added to every answer")
+    ap.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    opts = ap.parse_args()
+    srv = StubServer(Cassette(opts.cassette), latency=opts.latency, chunk_delay=opts.chunk_delay, port=opts.port)
+    print(f"🗄️ {len(srv.cassette)} recorded response(s) at {srv.url}/chat/completions")
+    try: srv.httpd.serve_forever()
+    except KeyboardInterrupt: pass
@@ -0,0 +1,101 @@
+"""
+Conflict-aware parallel execution of one round's tool_calls (test_api.py)
+Calls with disjoint sheet/range footprints run concurrently, overlapping ones in order
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+ALL = 1 << 30  # "to the end of the sheet" for row/column bounds
+WORKBOOK = "*"  # footprint sheet name that conflicts with everything
+
+_RANGE_READ = {"read_range": "range"}
+_RANGE_WRITE = {"format_range": "range", "sort_range": "range", "remove_duplicates": "range",
+                "clear_range": "range", "auto_filter": "range", "conditional_format": "range",
+                "set_validation": "range"}
+_CELL = {"read_cell": False, "write_cell": True}
+_SHEET_READ = {"get_sheet_info"}
+_SHEET_WRITE = {"delete_rows", "insert_rows", "freeze_panes"}
+_META_READ = {"get_workbook_info", "list_charts", "list_pivot_tables"}
+
+
+def footprint(wb, name, args):
+    """``(reads, writes)`` of a call as lists of ``(sheet, r1, c1, r2, c2)``.
+
+    Sheet-structure changes (add/rename/delete sheet, pivots, charts,
+    move_table), formulas and anything that cannot be parsed write the whole
+    workbook, i.e. act as a barrier. While the workbook has live pivots or
+    formulas every write is a barrier too, because the refresh after it
+    writes elsewhere.
+    """
+    sn = (args.get("sheet") or wb.active).lower()
+    whole = (sn, 1, 1, ALL, ALL)
+    barrier = ([], [(WORKBOOK, 1, 1, ALL, ALL)])
+    try:
+        if name in _RANGE_READ: reads, writes = [(sn,) + wb._pr(args[_RANGE_READ[name]])], []
+        elif name in _RANGE_WRITE: reads, writes = [], [(sn,) + wb._pr(args[_RANGE_WRITE[name]])]
+        elif name in _CELL:
+            if _CELL[name] and _formula(args.get("value")): return barrier
+            r, c = wb._pc(args["cell"])
+            reads, writes = ([], [(sn, r, c, r, c)]) if _CELL[name] else ([(sn, r, c, r, c)], [])
+        elif name == "write_range":
+            r, c = wb._pc(args["start_cell"])
+            data = args.get("data") or [[]]
+            if any(_formula(v) for row in data for v in row): return barrier
+            w = max((len(row) for row in data), default=1) or 1
+            reads, writes = [], [(sn, r, c, r + max(len(data), 1) - 1, c + w - 1)]
+        elif name == "find_replace":
+            reads, writes = [], [(sn,) + wb._pr(args["range"]) if args.get("range") else whole]
+        elif name == "copy_range":
+            src = (sn,) + wb._pr(args["source"])
+            r, c = wb._pc(args["destination"].split(":")[0])
+            ds = (args.get("dest_sheet") or sn).lower()
+            reads, writes = [src], [(ds, r, c, r + src[3] - src[1], c + src[4] - src[2])]
+        elif name in _SHEET_READ: reads, writes = [whole], []
+        elif name in _SHEET_WRITE: reads, writes = [], [whole]
+        elif name in _META_READ: reads, writes = [(WORKBOOK, 0, 0, 0, 0)], []
+        else: return barrier
+    except (KeyError, ValueError, TypeError, AttributeError):
+        return barrier
+    if writes and (getattr(wb, "_pe", None) or getattr(wb, "_fx", None)): return barrier
+    return reads, writes
+
+
+def _formula(v):
+    return isinstance(v, str) and v.startswith("=") and len(v) > 1
+
+
+def _hit(a, b):
+    if a[0] != b[0] and WORKBOOK not in (a[0], b[0]): return False
+    if WORKBOOK in (a[0], b[0]) and (a[3] == 0 or b[3] == 0):
+        return True  # workbook metadata read vs. anything that writes
+    return a[1] <= b[3] and b[1] <= a[3] and a[2] <= b[4] and b[2] <= a[4]
+
+
+def conflicts(fa, fb):
+    """True if two footprints must keep their relative order (a write touches the other)."""
+    (ra, wa), (rb, wb) = fa, fb
+    return any(_hit(x, y) for x in wa for y in rb + wb) or any(_hit(x, y) for x in ra for y in wb)
+
+
+def run_calls(calls, fn, fps, workers=4):
+    """Run ``fn(call)`` for every call; returns results in the original order.
+
+    Each call waits only for the latest earlier calls it conflicts with
+    (per ``fps``, the footprints), so a round takes about as long as its
+    longest dependency chain instead of the sum of all calls.
+    """
+    if workers <= 1 or len(calls) <= 1: return [fn(c) for c in calls]
+    deps = []
+    for j in range(len(calls)):
+        deps.append([i for i in range(j) if conflicts(fps[i], fps[j])])
+    with ThreadPoolExecutor(max_workers=min(workers, len(calls))) as ex:
+        futs = []
+        for j, call in enumerate(calls):
+            before = [futs[i] for i in deps[j]]
+            futs.append(ex.submit(_after, before, fn, call))
+        return [f.result() for f in futs]
+
+
+def _after(before, fn, call):
+    # dependencies were submitted earlier, so they are running or done: no deadlock
+    for f in before: f.result()
+    return fn(call)
@@ -0,0 +1,89 @@
+"""
+Token-budgeted history compaction for the run() tool loop (test_api.py)
+Stale tool results are swapped for short summaries once the prompt nears its budget
+"""
+import json
+
+CHARS_PER_TOKEN = 4  # local estimate before the first usage report calibrates it
+MSG_OVERHEAD = 4     # role/framing tokens per message
+
+
+def estimate(msg):
+    """Rough token count of one chat message (content plus tool call arguments)."""
+    n = len(msg.get("content") or "")
+    for tc in msg.get("tool_calls") or []:
+        n += len(tc["function"]["name"]) + len(tc["function"].get("arguments") or "")
+    return MSG_OVERHEAD + n // CHARS_PER_TOKEN
+
+
+def summarize(content):
+    """Compact form of a tool result: scalars kept, arrays reduced to their shape."""
+    try: d = json.loads(content)
+    except ValueError:
+        return content if len(content) <= 120 else content[:117] + "..."
+    if not isinstance(d, dict): return json.dumps({"compacted": True})
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, list):
+            inner = len(v[0]) if v and isinstance(v[0], list) else None
+            out[k] = f"<{len(v)}x{inner} compacted>" if inner is not None else f"<{len(v)} items compacted>"
+        elif isinstance(v, dict): out[k] = f"<{len(v)} keys compacted>"
+        elif isinstance(v, str) and len(v) > 80: out[k] = v[:77] + "..."
+        else: out[k] = v
+    out["compacted"] = True
+    return json.dumps(out, ensure_ascii=False)
+
+
+class History:
+    """Keeps the prompt of one run() under ``budget`` tokens.
+
+    Message cost is the local estimate scaled by ``prompt_tokens`` from the
+    last ``usage`` report, so the budget tracks the server's tokenizer.
+    ``compact()`` rewrites the oldest tool results first and never touches
+    those of the last ``keep_rounds`` assistant turns; the tool message and
+    its ``tool_call_id`` stay in place, so call/result pairing remains valid.
+    """
+
+    def __init__(self, budget, keep_rounds=2):
+        self.budget = budget
+        self.keep_rounds = keep_rounds
+        self.scale = 1.0
+        self.done = {}   # id() of compacted tool message -> estimated tokens it saves (unscaled)
+        self.saved = []  # per compact() call: estimated prompt tokens saved by all compaction so far
+
+    def tokens(self, msgs, tls=None):
+        # tls: tool schemas, as a list or already encoded JSON
+        est = sum(map(estimate, msgs))
+        if tls: est += len(tls if isinstance(tls, (bytes, str)) else json.dumps(tls)) // CHARS_PER_TOKEN
+        return int(est * self.scale)
+
+    def observe(self, msgs, tls, usage):
+        """Calibrate the estimate against the server's prompt_tokens for ``msgs``."""
+        pt = (usage or {}).get("prompt_tokens")
+        self.scale = 1.0
+        est = self.tokens(msgs, tls)
+        if pt and est: self.scale = pt / est
+
+    def compact(self, msgs, tls=None):
+        """Compact stale tool results until under budget.
+
+        Returns the tokens this prompt saves against its uncompacted form,
+        i.e. counting every message compacted so far, not just this call's.
+        """
+        total = self.tokens(msgs, tls)
+        saved = 0
+        if self.budget and total > self.budget:
+            turns = [i for i, m in enumerate(msgs) if m.get("role") == "assistant" and m.get("tool_calls")]
+            fresh = turns[-self.keep_rounds] if len(turns) >= self.keep_rounds else 0
+            for i, m in enumerate(msgs[:fresh]):
+                if total - saved <= self.budget: break
+                if m.get("role") != "tool" or id(m) in self.done: continue
+                short = summarize(m.get("content") or "")
+                gain = estimate(m) - estimate({"content": short})
+                if gain <= 0: continue
+                msgs[i] = dict(m, content=short)
+                self.done[id(msgs[i])] = gain
+                saved += int(gain * self.scale)
+        in_effect = int(sum(self.done.get(id(m), 0) for m in msgs) * self.scale)
+        self.saved.append(in_effect)
+        return in_effect
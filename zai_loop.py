@@ -0,0 +1,89 @@
+"""
+Loop detection for the run() tool loop (test_api.py)
+Canonical call hashes over a sliding window: repeats, short cycles and re-reads of unchanged ranges
+"""
+import json
+from collections import deque
+
+from zai_exec import conflicts
+
+_ADDR = {"cell", "start_cell", "dest_cell", "range", "source", "destination", "source_range"}
+_SHEET = {"sheet", "dest_sheet"}
+
+
+def canonical(wb, name, args):
+    """Call as a stable string: addresses normalised (``$a$1`` → ``A1``,
+    ``B2:A1`` → ``A1:B2``), sheet names defaulted and case-folded, keys sorted."""
+    out = {}
+    for k, v in args.items():
+        if k in _ADDR and isinstance(v, str):
+            try:
+                r1, c1, r2, c2 = wb._pr(v.strip())
+                r1, r2, c1, c2 = min(r1, r2), max(r1, r2), min(c1, c2), max(c1, c2)
+                v = f"{wb._cl(c1)}{r1}" + ("" if (r1, c1) == (r2, c2) else f":{wb._cl(c2)}{r2}")
+            except (ValueError, IndexError): v = v.strip().upper()
+        elif k in _SHEET and isinstance(v, str): v = v.strip().casefold()
+        out[k] = v
+    if not out.get("sheet"): out["sheet"] = wb.active.casefold()
+    return json.dumps([name, out], sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class LoopGuard:
+    """Per-run() loop state: the last ``window`` rounds as tuples of call hashes
+    and the results of read-only calls, valid until a write overlaps them.
+
+    ``check()`` reports ``repeat`` (the same round ``max_repeats`` more times in
+    a row) or ``cycle N`` (the last N rounds repeat the N before them, N ≥ 2).
+    ``lookup()`` answers re-reads from the cache; ``idle`` counts consecutive
+    rounds answered entirely from it.
+    """
+
+    def __init__(self, wb, window=8, max_repeats=2):
+        self.wb = wb
+        self.max_repeats = max_repeats
+        self.rounds = deque(maxlen=window)
+        self.cache = {}  # call hash -> (footprint, result)
+        self.idle = 0
+
+    def key(self, name, args):
+        return hash(canonical(self.wb, name, args))
+
+    def seen(self, key):
+        """True if the call was made in any round still in the window."""
+        return any(key in r for r in self.rounds)
+
+    def check(self, keys):
+        """Add a round; returns why it is a loop, or None."""
+        sig = tuple(keys)
+        seq = list(self.rounds) + [sig]
+        self.rounds.append(sig)
+        same = 0
+        for prev in reversed(seq[:-1]):
+            if prev != sig: break
+            same += 1
+        if same >= self.max_repeats: return "repeat"
+        for p in range(2, len(seq) // 2 + 1):
+            if seq[-p:] == seq[-2 * p:-p] and len(set(seq[-p:])) > 1: return f"cycle {p}"
+        return None
+
+    def lookup(self, keys, fps, only):
+        """``{index: result}`` for the calls in ``only`` that re-read an unchanged range.
+
+        A call is answered only if no earlier call of the same round writes
+        over what it reads.
+        """
+        hits, writes = {}, []
+        for i in range(len(keys)):
+            r, w = fps[i]
+            if i in only and not w and keys[i] in self.cache and not any(conflicts(fps[i], x) for x in writes):
+                hits[i] = dict(self.cache[keys[i]][1], unchanged=True)
+            if w: writes.append(fps[i])
+        self.idle = self.idle + 1 if hits and len(hits) == len(keys) else 0
+        return hits
+
+    def record(self, key, fp, result):
+        """Cache a read-only result, or drop the cached reads a write overlaps."""
+        if fp[1]:
+            self.cache = {k: v for k, v in self.cache.items() if not conflicts(v[0], fp)}
+        elif isinstance(result, dict) and "error" not in result:
+            self.cache[key] = (fp, result)
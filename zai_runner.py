@@ -0,0 +1,138 @@
+"""
+Concurrent scenario runner for test_api.py
+Pooled keep-alive session, token-bucket request limiter with 429/1302 back-off
+"""
+import io, json, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def make_session(pool=16):
+    """requests.Session whose adapter keeps up to ``pool`` connections alive per host."""
+    s = requests.Session()
+    ad = HTTPAdapter(pool_connections=4, pool_maxsize=pool, max_retries=0)
+    s.mount("https://", ad)
+    s.mount("http://", ad)
+    return s
+
+
+def is_rate_limited(r):
+    """True for HTTP 429 or a z.ai ``error.code`` of 1302 (same check as ZaiApiService.TranslateApiError)."""
+    if r.status_code == 429: return True
+    if r.status_code < 400: return False
+    try: return str(json.loads(r.text)["error"]["code"]) == "1302"
+    except Exception: return False
+
+
+class RateLimiter:
+    """Token bucket on request starts plus a cap on requests in flight.
+
+    ``rate`` tokens per second refill up to ``burst``; every request takes one
+    token and one in-flight slot. ``backoff()`` halves the rate and pauses all
+    callers (honouring Retry-After); each ``ok()`` creeps the rate back up
+    towards the configured maximum.
+    """
+
+    def __init__(self, rate=4.0, burst=4, in_flight=8, min_rate=0.2):
+        self.max_rate = self.rate = float(rate)
+        self.min_rate = min_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.until = 0.0  # monotonic time before which nobody may start
+        self.fails = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(in_flight)
+
+    def _take(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                wait = self.until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        self._slots.acquire()
+        try: self._take()
+        except BaseException:
+            self._slots.release(); raise
+        return self
+
+    def __exit__(self, *exc):
+        self._slots.release()
+
+    def backoff(self, retry_after=None):
+        """Register a rate-limit response; returns the pause applied in seconds."""
+        with self._lock:
+            self.fails += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            pause = retry_after if retry_after else min(30.0, 0.5 * 2 ** min(self.fails, 6))
+            self.until = max(self.until, time.monotonic() + pause)
+            self.tokens = 0.0
+            return pause
+
+    def ok(self):
+        with self._lock:
+            self.fails = 0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+# ── per-thread stdout ──
+class _ThreadOut(io.TextIOBase):
+    # Routes print() from worker threads into per-scenario buffers so the
+    # scenario logs are not interleaved; other threads write through.
+    def __init__(self, real):
+        self.real = real
+        self.local = threading.local()
+
+    def write(self, s):
+        buf = getattr(self.local, "buf", None)
+        return (buf or self.real).write(s)
+
+    def flush(self):
+        if getattr(self.local, "buf", None) is None: self.real.flush()
+
+
+def run_many(jobs, workers=4):
+    """Run ``jobs`` (list of ``(label, fn)``) on a thread pool.
+
+    Each job's printed output is buffered and emitted in one piece when it
+    finishes. Returns ``{label: fn() result}`` in the order of ``jobs``; a job
+    that raises maps to ``None``. Labels must be unique (ValueError otherwise).
+    """
+    seen, dup = set(), []
+    for label, _ in jobs:
+        if label in seen: dup.append(label)
+        seen.add(label)
+    if dup: raise ValueError(f"Duplicate job label(s): {', '.join(map(str, dup))}")
+    out = _ThreadOut(sys.stdout)
+    lock = threading.Lock()
+
+    def go(label, fn):
+        out.local.buf = io.StringIO()
+        try:
+            return fn()
+        except Exception as ex:
+            print(f"  ❌ {label}: {ex}")
+            return None
+        finally:
+            text, out.local.buf = out.local.buf.getvalue(), None
+            with lock:
+                out.real.write(text); out.real.flush()
+
+    prev, sys.stdout = sys.stdout, out
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
+            futs = [(label, ex.submit(go, label, fn)) for label, fn in jobs]
+            return {label: f.result() for label, f in futs}
+    finally:
+        sys.stdout = prev
@@ -0,0 +1,94 @@
+"""
+Server-sent event (SSE) handling for streamed z.ai /chat/completions
+Incremental tool_call assembly with time-to-first-token / first-tool-call timing
+"""
+import json, time
+
+
+def assemble(lines, t0=None, on_tool=None):
+    """Build a regular completion response from ``data: {...}`` SSE lines.
+
+    ``tool_calls`` argument fragments are joined per ``index``. A call is
+    complete once a later index starts or the stream finishes, and
+    ``on_tool(index, tool_call)`` fires at that moment, so a caller can start
+    executing it while the rest of the answer is still being generated.
+    The result carries ``_timing``: ``ttft`` (first content or tool delta),
+    ``ttfc`` (first complete tool call) and ``total``, in seconds from ``t0``.
+    """
+    t0 = time.perf_counter() if t0 is None else t0
+    text, calls = [], []
+    fin = usage = rid = None
+    ttft = ttfc = None
+
+    def complete(upto):
+        nonlocal ttfc
+        for i in range(len(calls)):
+            tc = calls[i]
+            if i >= upto or tc.get("_done"): continue
+            tc["_done"] = True
+            if ttfc is None: ttfc = time.perf_counter() - t0
+            if on_tool: on_tool(i, _public(tc))
+
+    for line in lines:
+        if isinstance(line, bytes): line = line.decode("utf-8")
+        if not line.startswith("data:"): continue
+        payload = line[5:].strip()
+        if payload == "[DONE]": break
+        ch = json.loads(payload)
+        rid = rid or ch.get("id")
+        if ch.get("usage"): usage = ch["usage"]
+        for c in ch.get("choices") or []:
+            d = c.get("delta") or {}
+            if d.get("content"):
+                if ttft is None: ttft = time.perf_counter() - t0
+                text.append(d["content"])
+            for td in d.get("tool_calls") or []:
+                if ttft is None: ttft = time.perf_counter() - t0
+                i = td.get("index", len(calls))
+                complete(i)
+                while len(calls) <= i:
+                    calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+                tc = calls[i]
+                if td.get("id"): tc["id"] = td["id"]
+                fn = td.get("function") or {}
+                if fn.get("name"): tc["function"]["name"] += fn["name"]
+                if fn.get("arguments"): tc["function"]["arguments"] += fn["arguments"]
+            if c.get("finish_reason"): fin = c["finish_reason"]
+    complete(len(calls))
+
+    msg = {"role": "assistant", "content": "".join(text)}
+    if calls: msg["tool_calls"] = [_public(tc) for tc in calls]
+    return {"id": rid, "object": "chat.completion",
+            "choices": [{"index": 0, "message": msg, "finish_reason": fin}], "usage": usage,
+            "_timing": {"ttft": ttft, "ttfc": ttfc, "total": time.perf_counter() - t0}}
+
+
+def _public(tc):
+    return {k: v for k, v in tc.items() if k != "_done"}
+
+
+def events(resp, piece=16):
+    """SSE ``data`` payloads (JSON strings, then ``[DONE]``) that replay ``resp``.
+
+    Content and tool arguments are cut into ``piece``-character fragments the
+    way the real endpoint sends them.
+    """
+    ch = resp["choices"][0]
+    msg = ch["message"]
+    base = {"id": resp.get("id"), "object": "chat.completion.chunk", "model": resp.get("model")}
+    def chunk(delta, fin=None, **extra):
+        return json.dumps(dict(base, choices=[{"index": 0, "delta": delta, "finish_reason": fin}], **extra),
+                          ensure_ascii=False)
+    yield chunk({"role": "assistant"})
+    content = msg.get("content") or ""
+    for i in range(0, len(content), piece):
+        yield chunk({"content": content[i:i + piece]})
+    for n, tc in enumerate(msg.get("tool_calls") or []):
+        fn = tc["function"]
+        yield chunk({"tool_calls": [{"index": n, "id": tc["id"], "type": "function",
+                                     "function": {"name": fn["name"], "arguments": ""}}]})
+        args = fn.get("arguments") or ""
+        for i in range(0, len(args), piece):
+            yield chunk({"tool_calls": [{"index": n, "function": {"arguments": args[i:i + piece]}}]})
+    yield chunk({}, ch.get("finish_reason") or "stop", usage=resp.get("usage"))
+    yield "[DONE]"
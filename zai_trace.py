@@ -0,0 +1,104 @@
+"""
+Span tracing for the run() loop (test_api.py)
+JSONL and Chrome trace_event export, p50/p95 report per tool and per round
+"""
+import json, math, os, threading, time
+
+
+class Span:
+    __slots__ = ("tracer", "name", "cat", "args", "t0")
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer, self.name, self.cat, self.args = tracer, name, cat, args
+
+    def set(self, **kw):
+        """Attach attributes (token counts, byte sizes, ...) to the span."""
+        self.args.update(kw)
+
+    def __enter__(self):
+        self.t0 = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, et, ev, tb):
+        t1 = time.perf_counter_ns()
+        if et is not None: self.args["error"] = et.__name__
+        self.tracer.events.append({"name": self.name, "cat": self.cat, "ts": self.t0, "dur": t1 - self.t0,
+                                   "tid": threading.get_ident(), "args": self.args})
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+    def set(self, **kw): pass
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+
+_NOSPAN = _NoSpan()
+
+
+class Tracer:
+    """Collects completed spans; a disabled tracer hands out one shared no-op span.
+
+    ``events`` holds dicts with ``name``, ``cat``, ``ts``/``dur`` in
+    perf_counter nanoseconds, ``tid`` and ``args``. list.append is atomic,
+    so spans may close on any thread.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+
+    def span(self, name, cat="", **args):
+        return Span(self, name, cat, args) if self.enabled else _NOSPAN
+
+    def export_jsonl(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for ev in self.events:
+                f.write(json.dumps(ev, ensure_ascii=False, default=str) + "\n")
+
+    def export_chrome(self, path):
+        """Chrome ``trace_event`` file (chrome://tracing, Perfetto): complete events in µs."""
+        t0 = min((ev["ts"] for ev in self.events), default=0)
+        tids = {}
+        evs = [{"name": ev["name"], "cat": ev["cat"] or "default", "ph": "X", "pid": os.getpid(),
+                "tid": tids.setdefault(ev["tid"], len(tids) + 1),
+                "ts": (ev["ts"] - t0) / 1e3, "dur": ev["dur"] / 1e3, "args": ev["args"]}
+               for ev in self.events]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": evs, "displayTimeUnit": "ms"}, f, ensure_ascii=False, default=str)
+
+    def report(self, key=None):
+        """``{(cat, name): {count, p50_ms, p95_ms, total_ms}}`` over all spans.
+
+        ``key(event)`` regroups events (e.g. rounds by number); None drops one.
+        """
+        groups = {}
+        for ev in self.events:
+            k = key(ev) if key else (ev["cat"], ev["name"])
+            if k is not None: groups.setdefault(k, []).append(ev["dur"] / 1e6)
+        out = {}
+        for k, ds in sorted(groups.items()):
+            ds.sort()
+            out[k] = {"count": len(ds), "p50_ms": _pct(ds, 0.50), "p95_ms": _pct(ds, 0.95), "total_ms": sum(ds)}
+        return out
+
+    def print_report(self, key=None):
+        print(f"\n  {'span':34} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'total ms':>10}")
+        for (cat, name), st in self.report(key).items():
+            print(f"  {(cat + ':' if cat else '') + name:34} {st['count']:5} {st['p50_ms']:9.2f} "
+                  f"{st['p95_ms']:9.2f} {st['total_ms']:10.1f}")
+
+
+def _pct(sorted_vals, q):
+    """Nearest-rank percentile: the ceil(q*n)-th smallest value.
+
+    >>> _pct([1, 2], 0.5), _pct([1, 2, 3, 4, 5, 6], 0.5), _pct(list(range(1, 21)), 0.95)
+    (1, 3, 19)
+    >>> _pct([7], 0.95), _pct([1, 2, 3], 0.0), _pct([1, 2, 3], 1.0)
+    (7, 1, 3)
+    """
+    return sorted_vals[min(len(sorted_vals) - 1, max(0, math.ceil(q * len(sorted_vals)) - 1))]
+
+
+TRACER = Tracer()